@@ -1,9 +1,14 @@
 from setuptools import setup, find_packages
 import os
+import re
+
+# version defined once, in src/spidi/__init__.py
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),'src','spidi','__init__.py')) as fin:
+    VERSION = re.search(r"^__version__ = '([^']*)'",fin.read(),re.M).group(1)
 
 setup(
     name="spidi",
-    version='0.1',
+    version=VERSION,
     author='ECMWF',
     description="ECMWF Standardized Precipitation Index and other Drought Indices library",
     packages=find_packages(where='src'),
@@ -23,6 +28,8 @@ setup(
             "spidi-cbias-seasonal=spidi.cbias_seasonal:main",
             "spidi-gpcc2grib=spidi.convGpcc2Grb:main",
             "spidi-clim-for=spidi.create_clm_for:main",
+            "spidi-index-mon=spidi.calc_index_mon:main",
+            "spidi-pipeline=spidi.pipeline:main",
         ],
     },
 )
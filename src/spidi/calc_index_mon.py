@@ -0,0 +1,110 @@
+# Compute several standardized drought indices (SPI, SPEI, SRI) for the
+# monitoring period in one pass over the data
+
+from __future__ import print_function
+
+import numpy as np
+import sys
+
+from spidi import core
+
+
+def load_var(FNAME,mon_keys):
+  """
+  Load a monitoring variable with the same fields (year,month) as MON_HIND
+  """
+  xdata,xkeys = core.load_grb_file(FNAME,retKeys=['year','month'],verbose=True)
+  assert ( np.array_equal(xkeys['year'],mon_keys['year']) and
+           np.array_equal(xkeys['month'],mon_keys['month']) ), \
+         "Fields of %s do not match the monitoring precipitation"%FNAME
+  return xdata
+
+def main(args=None):
+  ##===================================
+  ## Get required variables
+  OPT=core.get_opt(['AWDIR','SPITSCALE','HINDYSTART','HINDYEND'],args[1:])
+  print(OPT)
+  ## Optional settings:
+  ##  INDICES: comma separated list of indices (default spi), see core.indices
+  ##  PETFILE: monitoring potential evapotranspiration (mm/day, same fields
+  ##           as MON_HIND), required by spei
+  ##  ROFILE: monitoring runoff (same fields as MON_HIND), required by sri
+  ##  NTHREADS: number of threads for the fit and transform
+  ##  NPROC: number of processes used for grib encoding
+  ##  PROFILE: write a json run report (timings, memory, i/o) to this file
+  OPTO=core.get_opt(['INDICES','PETFILE','ROFILE','NTHREADS','NPROC','PROFILE'],args[1:])
+  names=(OPTO['INDICES'] or 'spi').lower().split(',')
+  nthreads=int(OPTO['NTHREADS'] or 1)
+  nproc=int(OPTO['NPROC'] or 1)
+  for name in names:
+    if name not in core.indices.REGISTRY:
+      print('Index not available!',name,sorted(core.indices.REGISTRY))
+      sys.exit(-1)
+  core.instrument.start(OPTO['PROFILE'],'spidi-index-mon')
+  for key in OPT.keys():
+    if OPT[key] is None:
+      print('Variable: ',key,' is not defined')
+      print('can be defined either in the calling environment: e.g export %s=value'%key)
+      print('or in the command line as --%s=value'%key)
+      print('Exiting')
+      sys.exit(-1)
+    else:
+      globals()[key]=OPT[key]
+
+  # testing: run calc_index_mon.py  --AWDIR=/disk1/data/work/dsuite/20160101/ --SPITSCALE=6 --HINDYEND=2016 --HINDYSTART=2007 --INDICES=spi,spei --PETFILE=/disk1/data/work/dsuite/20160101/MON_PET.grb
+
+  MONHTAG=core.MONHTAG
+  tscale=int(SPITSCALE)
+
+  ##=====================================
+  ## Load each input variable once
+  fnameMON="%s/%s.grb"%(AWDIR,MONHTAG)
+  mon_hindP,mon_keys = core.moncache.load_mon_hind(fnameMON,verbose=True)
+  ntTOT,ngpTOT = mon_hindP.shape
+  ## Set precip values bellow threshold to zero
+  mon_hindP[mon_hindP< core.PminDAY ] = 0.
+  data={'precip':mon_hindP}
+  fnames={'pet':OPTO['PETFILE'],'runoff':OPTO['ROFILE']}
+  for vv in core.indices.required_variables(names):
+    if vv in data:
+      continue
+    if fnames.get(vv) is None:
+      print('Input file for variable',vv,'not defined, required by',names)
+      sys.exit(-1)
+    data[vv] = load_var(fnames[vv],mon_keys)
+
+  ## Work on the grid points present in the bitmap of all the inputs
+  ipts = core.valid_points(mon_hindP)
+  for vv in data:
+    ipts = np.intersect1d(ipts,core.valid_points(data[vv]))
+  for vv in data:
+    data[vv] = data[vv][:,ipts]
+  print('Valid grid points:',len(ipts),'of',ngpTOT)
+
+  ##=====================================
+  ## Fit and transform all indices from the shared accumulations
+  months_hind=np.array(mon_keys['month'])
+  years_hind=np.array(mon_keys['year'])
+  lfit=(years_hind >= int(HINDYSTART)) & (years_hind <= int(HINDYEND))
+  results=core.indices.compute_indices(names,data,tscale,months_hind,lfit,nthreads)
+
+  ##=====================================
+  ## Save parameters and write each index (copy from precip...)
+  for name in names:
+    xind,params=results[name]
+    FPAR="%s/IPAR_%s%i_%s.npz"%(AWDIR,name.upper(),tscale,MONHTAG)
+    fout = open(FPAR,'wb')
+    np.savez(fout,params=core.unpack_points(params,ipts,ngpTOT))
+    fout.close()
+    print("File created:",FPAR)
+    FOUT="%s/%s%i_%s.grb"%(AWDIR,name.upper(),tscale,MONHTAG)
+    fout = open(FOUT,'wb')
+    ikfld = core.grbio.write_messages(fout,core.grbio.file_jobs(fnameMON,
+                                      core.unpack_points(xind,ipts,ngpTOT)),nproc)
+    fout.close()
+    print(ikfld,' fields written to:',FOUT)
+  core.instrument.finish()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -13,24 +13,51 @@ import eccodes as ec
 from spidi import core
 
 
-def acc_precip(fyr,fmon,fclead,tscale,for_keys,for_hind,mon_keys,mon_hindF,
-               kidia=None,kfdia=None,verbose=False):
-      
-  indHY = np.nonzero(for_keys['fdate']/10000 == fyr)[0][0] # year index in forecast hindcast array 
-  indHLE = fclead # last lead index in forecast hindcast array 
-  indHLS = np.maximum(0,indHLE-tscale) # start lead index in forecast hindcast array 
-  
+def acc_prep(for_hind,mon_hindF,tscale,forLead,kidia=None,kfdia=None,mon_rows=None):
+  """
+  Rolling accumulations used by acc_precip:
+   accF: forecast precipitation accumulated over the leads (up to tscale)
+   accM: monitoring precipitation accumulated over the number of months
+         needed to complete tscale for each lead {nmonths: np.array}
+         (only the rows in mon_rows, as {nmonths: {row: np.array}}, if given)
+  """
+  return acc_prep_for(for_hind,tscale),acc_prep_mon(mon_hindF,tscale,forLead,kidia,kfdia,mon_rows)
+
+def acc_prep_for(for_hind,tscale):
+  return core.rolling.rolling_sum(for_hind,tscale,axis=1,dtype=np.float32,
+                                  method='direct',partial=True)
+
+def acc_prep_mon(mon_hindF,tscale,forLead,kidia=None,kfdia=None,mon_rows=None):
+  nmon = sorted(set([max(0,tscale-fclead) for fclead in forLead]))
+  accM = core.rolling.rolling_sums(mon_hindF[:,kidia:kfdia],nmon,axis=0,dtype=np.float32,
+                                   method='compensated',index=mon_rows)
+  if mon_rows is not None:
+    for nn in nmon:
+      accM[nn] = dict(zip(mon_rows,accM[nn]))
+  return accM
+
+def mon_end_index(fyr,fmon,mon_keys):
+  """
+  Index (+1) of the last monitoring month before the forecast start fyr/fmon
+  """
   fmonP = fmon-1
   fyrP = fyr+0
   if fmonP == 0:
     fmonP=12
     fyrP=fyr-1
-    
-  indME = np.nonzero((mon_keys['year'] == fyrP ) & (mon_keys['month'] == fmonP))[0][0] + 1
+  return np.nonzero((mon_keys['year'] == fyrP ) & (mon_keys['month'] == fmonP))[0][0] + 1
+
+def acc_precip(fyr,fmon,fclead,tscale,for_keys,accF,mon_keys,accM,verbose=False):
+      
+  indHY = np.nonzero(for_keys['fdate']//10000 == fyr)[0][0] # year index in forecast hindcast array 
+  indHLE = fclead # last lead index in forecast hindcast array 
+  indHLS = np.maximum(0,indHLE-tscale) # start lead index in forecast hindcast array 
+  
+  indME = mon_end_index(fyr,fmon,mon_keys)
   indMS = np.minimum(indME,indME-tscale+fclead)
     
-  lenF=for_hind[indHY,indHLS:indHLE,:,:].shape[0]
-  lenM=mon_hindF[indMS:indME,:].shape[0]
+  lenF=indHLE-indHLS
+  lenM=indME-indMS
   assert lenF+lenM == tscale , '# months do not match to spi time scale'
   if verbose:
     indMEp=np.minimum(indME,len(mon_keys['year'])-1)
@@ -42,7 +69,8 @@ def acc_precip(fyr,fmon,fclead,tscale,for_keys,for_hind,mon_keys,mon_hindF,
                  '(',(indME-indMS),')','Ntfor:',lenF,'NtMon:',lenM)
     print('')
     
-  return np.sum(for_hind[indHY,indHLS:indHLE,:,:],axis=0) + np.sum(mon_hindF[indMS:indME,kidia:kfdia],axis=0)
+  # accumulated forecast leads indHLS:indHLE + monitoring months indMS:indME
+  return accF[indHY,indHLE-1,:,:] + accM[lenM][indME-1]
 
 def load_hind(ystart,yend,kidia=None,kfdia=None):
   ##====================================
@@ -70,9 +98,26 @@ def load_hind(ystart,yend,kidia=None,kfdia=None):
   return xdata,xkeys
   #sys.exit()
   
-def save_gamma_params(GammaP):
+def emp_clim_fname():
+  """
+  File with the sorted climatologies of the empirical SPI
+  """
+  return "%s/ECLIM_SPI%i_%s_%s_%02i.npz"%(AWDIR,tscale,FTYPE,FORTYPE,fmon)
+
+def gfit_fname(ftag,cvyear=None):
+  """
+  File with the gamma fit parameter ftag (acoef,bcoef or pzero)
+  cvyear: hindcast year left out of the fit (cross-validated parameters)
+  """
+  fname="%s/GFIT_SPI%i_%s_%s_%s_%02i"%(AWDIR,tscale,ftag,FTYPE,FORTYPE,fmon)
+  if cvyear is not None:
+    fname="%s_CV%04i"%(fname,cvyear)
+  return fname+".grb"
+
+@core.instrument.timed('save_gamma_params')
+def save_gamma_params(GammaP,cvyear=None):
   FTEMPLATE="%s/%s.grb"%(AWDIR,MONHTAG)
-  fin = open(FTEMPLATE)
+  fin = open(FTEMPLATE,'rb')
   gid = ec.codes_grib_new_from_file(fin)
   clone_id = ec.codes_clone(gid)
   ec.codes_release(gid)
@@ -82,76 +127,230 @@ def save_gamma_params(GammaP):
   ftags={0:'acoef',1:'bcoef',2:'pzero'}
   nleadF,ii,ii = GammaP.shape
   for ik in range(3): # loop on the 3 parameters 
-    fnameOUT="%s/GFIT_SPI%i_%s_%s_%s_%02i.grb"%(AWDIR,tscale,ftags[ik],FTYPE,FORTYPE,fmon)
+    fnameOUT=gfit_fname(ftags[ik],cvyear)
     print("Writing to output:",fnameOUT)
-    fout = open(fnameOUT,'w')
+    fout = open(fnameOUT,'wb')
+    xkeep = [] # as decoded from the written messages, for core.memstore
     for im in range(nleadF):
       xtmp = np.ma.filled(np.ma.fix_invalid(GammaP[im,ik,:]),core.ZMISS)
       ec.codes_set_values(clone_id,xtmp)
       ec.codes_set(clone_id,'dataDate',int("2016%02i01"%(im+1)))
       ec.codes_write(clone_id, fout)
+      if core.memstore.enabled():
+        xkeep.append(core.grbio.decode_values(ec.codes_get_message(clone_id)))
+    fout.close()
+    core.instrument.count_io(fnameOUT,'write',nleadF)
+    if core.memstore.enabled():
+      core.memstore.put(fnameOUT,['year','month'],np.array(xkeep),
+                        {'year':np.repeat(2016,nleadF),'month':np.arange(1,nleadF+1)})
   ec.codes_release(clone_id)
-  fout.close()
   return
 
-def fit_hind():
+def fit_hind(spimethod='gamma',cvfit=False,pcache=None,ckdir=None):
+  """
+  Fit the SPI parameters on the hindcast period and save them, the fit is
+  read from the parameter cache pcache (if any) when the inputs and the
+  options are unchanged
+  ckdir: scratch directory for the checkpoint of the hindcast years already
+         processed, used to resume an interrupted run (disabled if None)
+  """
+  fnames=[core.moncache.source_fname("%s/%s.grb"%(AWDIR,MONHTAG))]
+  for fyr in range(ystartH,yendH+1):
+    fnames.append(core.gen_for_fname(AWDIR,FTYPE,SEASVER,"%i%02i01"%(fyr,fmon),FORTYPE))
+  ckpt=None
+  if ckdir is not None:
+    ckpt=core.checkpoint.Checkpoint(ckdir,
+                                    "FITHIND_SPI%i_%s_%s_%02i"%(tscale,FTYPE,FORTYPE,fmon),
+                                    {'tscale':tscale,'fmon':fmon,
+                                     'hindystart':ystartH,'hindyend':yendH,
+                                     'method':spimethod,'cvfit':cvfit,
+                                     'PminDAY':core.PminDAY,
+                                     'files':core.checkpoint.file_signature(fnames)})
+  pdata=None
+  if pcache is not None:
+    pkey=core.pcache.cache_key(fnames,
+                               {'entry':'spi-for','tscale':tscale,'fmon':fmon,
+                                'FTYPE':FTYPE,'FORTYPE':FORTYPE,
+                                'hindystart':ystartH,'hindyend':yendH,
+                                'method':spimethod,'cvfit':cvfit,
+                                'PminDAY':core.PminDAY,'ZeroMax':core.ZeroMax})
+    pdata=pcache.get(pkey)
+  if pdata is None:
+    pdata=fit_hind_stream(spimethod,cvfit,ckpt)
+    if pcache is not None:
+      pcache.put(pkey,**pdata)
+
+  #save gamma fit parameters     
+  if spimethod == 'empirical':
+    core.save_emp_clim(emp_clim_fname(),pdata['EClim'],pdata['GammaP'][:,2,:])
+  else:
+    save_gamma_params(pdata['GammaP'])
+  if cvfit:
+    for iy,fyr in enumerate(range(ystartH,yendH+1)):
+      save_gamma_params(pdata['GammaPCV'][iy,:,:,:],cvyear=fyr)
+  if ckpt is not None:
+    ckpt.clear()
+
+def fit_hind_stream(spimethod='gamma',cvfit=False,ckpt=None):
+  """
+  Fit the SPI parameters streaming the hindcast years
+  ckpt: core.checkpoint.Checkpoint, the accumulators are saved after each
+        year (running totals, or the part of the year with CVFIT and the
+        empirical method) and the years done in a previous run are skipped
+  returns a dictionary with GammaP (nlead,3,ngp) and, depending on the
+  options, GammaPCV (nyear,nlead,3,ngp) or EClim (nlead,nsample,ngp)
+  """
 
   ##===================================
   ## 1. Load monitoring 
-  mon_hindF,mon_keys = core.load_grb_file("%s/%s.grb"%(AWDIR,MONHTAG),
-                                        retKeys=['year','month'],verbose=False)
+  mon_hindF,mon_keys = core.moncache.load_mon_hind("%s/%s.grb"%(AWDIR,MONHTAG),
+                                                verbose=False)
   ## Set precip values bellow threshold to zero
   mon_hindF[mon_hindF< core.PminDAY ] = 0. 
   ntHIND,ngpTOT = mon_hindF.shape
 
-  ## Compute domain partitioning
-  nslots = ngpTOT/npMAX + 1
-  pslots = np.floor(np.linspace(0,ngpTOT,nslots+1)).astype(np.int)
+  ## Monitoring accumulations ending before each hindcast start
+  yearsH = range(ystartH,yendH+1)
+  mon_rows = [mon_end_index(fyr,fmon,mon_keys)-1 for fyr in yearsH]
 
-  for iks in range(nslots):
-    kidia = pslots[iks]
-    kfdia = pslots[iks+1]
+  ## Accumulators of the years done in a previous run (if any)
+  done,acc = [],{}
+  if ckpt is not None:
+    done,acc = ckpt.load()
+  resumed = list(done)
+  GStats=acc.get('GStats')
+  EClim=None
+  ipts=acc.get('ipts')
+  accM=None
+  lyearly = spimethod == 'empirical' or cvfit # accumulators with a part per year
 
-    ###=====================================
-    ### Load MON HIND data 
-    #kidia=None
-    #kfdia=None
-    for_hind,for_keys=load_hind(ystartH,yendH,kidia,kfdia)
+  ##=====================================
+  ## 2. Stream the hindcast years, updating the gamma fit sufficient
+  ##    statistics (count, non-zero count, sum, sum log) per lead time
+  for iy,fyr in enumerate(yearsH):
+    if fyr in done:
+      print('Skipping year',fyr,'(checkpoint)')
+      continue
+    for_hind,for_keys=load_hind(fyr,fyr)
+    if ipts is None:
+      ## Work on the grid points present in the forecast (bitmap) only,
+      ## the monitoring data only enter the accumulations of the leads
+      ## shorter than tscale (missing there where the monitoring is)
+      ipts = core.valid_points(for_hind.reshape(-1,ngpTOT))
+    for_hind = for_hind[...,ipts]
     nyear,nleadF,nens,ngpF = for_hind.shape
+    ngpV = len(ipts)
     ## Set precip values bellow threshold to zero
     for_hind[for_hind< core.PminDAY ] = 0. 
 
     ##====================================
-    ## Allocate GamaP array
-    if iks == 0:
-      GammaP=np.zeros((nleadF,3,ngpTOT),dtype=np.float32)-99999.
-
+    ## Allocate accumulators
+    if accM is None:
+      print('Valid grid points:',ngpV,'of',ngpTOT)
+      accM = acc_prep_mon(mon_hindF[:,ipts],tscale,for_keys['forLead'],mon_rows=mon_rows)
+    if GStats is None and EClim is None:
+      if spimethod == 'empirical':
+        EClim=np.zeros((nleadF,nyearH*nens,ngpV),dtype=np.float32)*np.nan
+      elif cvfit:
+        GStats=np.zeros((nyearH,nleadF,4,ngpV))
+      else:
+        GStats=np.zeros((nleadF,4,ngpV))
 
     ##=======================================
     ## Accumulate precipitation for a specific lead time and spi time-scale
+    accF = acc_prep_for(for_hind,tscale)
+    print('Accumulating year',fyr)
+    for ilead,fclead in enumerate(for_keys['forLead']):
+      xprecA = acc_precip(fyr,fmon,fclead,tscale,for_keys,accF,mon_keys,accM,
+                          verbose=False)
+      if spimethod == 'empirical':
+        EClim[ilead,iy*nens:(iy+1)*nens,:] = xprecA
+      elif cvfit:
+        GStats[iy,ilead,:,:] = core.gamma_stats(xprecA)
+      else:
+        GStats[ilead,:,:] += core.gamma_stats(xprecA)
+    done.append(fyr)
+    if ckpt is not None:
+      if spimethod == 'empirical':
+        ckpt.save_step(fyr,EClim=EClim[:,iy*nens:(iy+1)*nens,:])
+        ckpt.save(done,ipts=ipts)
+      elif cvfit:
+        ckpt.save_step(fyr,GStats=GStats[iy])
+        ckpt.save(done,ipts=ipts)
+      else:
+        ckpt.save(done,GStats=GStats,ipts=ipts)
 
-    # Main loop on lead time 
+  ## Parts of the years done in a previous run
+  for iy,fyr in enumerate(yearsH):
+    if not lyearly or fyr not in resumed:
+      continue
+    xx = ckpt.load_step(fyr)
+    if spimethod == 'empirical':
+      nleadF,nens,ngpV = xx['EClim'].shape
+      if EClim is None:
+        EClim=np.zeros((nleadF,nyearH*nens,ngpV),dtype=np.float32)*np.nan
+      EClim[:,iy*nens:(iy+1)*nens,:] = xx['EClim']
+    else:
+      if GStats is None:
+        GStats=np.zeros((nyearH,)+xx['GStats'].shape)
+      GStats[iy] = xx['GStats']
 
-    for ilead,fclead in enumerate(for_keys['forLead']):
-      xprecA = np.zeros((nyearH,nens,ngpF))
-      print('Fitting lead time',ilead)
-      for iy,fyr in enumerate(range(ystartH,yendH+1)):
-        xprecA[iy,:,:] = acc_precip(fyr,fmon,fclead,tscale,for_keys,for_hind,mon_keys,mon_hindF,
-                                    kidia,kfdia,verbose=False)
-      ## do the gamma fitting
-      coef,q = core.fspi_fit(xprecA.reshape(nyearH*nens,ngpF),core.ZeroMax,-1)
-      GammaP[ilead,0,kidia:kfdia]=coef[0,:]
-      GammaP[ilead,1,kidia:kfdia]=coef[1,:]
-      GammaP[ilead,2,kidia:kfdia]=q.copy()
+  ##=====================================
+  ## 3. Fit per lead time
+  ngpV = len(ipts)
+  if spimethod == 'empirical':
+    nleadF = EClim.shape[0]
+  else:
+    nleadF = GStats.shape[-3]
+  GammaP=np.zeros((nleadF,3,ngpV),dtype=np.float32)-99999.
+  for ilead in range(nleadF):
+    print('Fitting lead time',ilead)
+    if spimethod == 'empirical':
+      EClim[ilead,:,:],GammaP[ilead,2,:] = core.fspi_emp_fit(EClim[ilead,:,:],core.ZeroMax)
+      continue
+    ## do the gamma fitting
+    if cvfit:
+      coef,q = core.gamma_from_stats(np.sum(GStats[:,ilead,:,:],axis=0),core.ZeroMax)
+    else:
+      coef,q = core.gamma_from_stats(GStats[ilead,:,:],core.ZeroMax)
+    GammaP[ilead,0,:]=coef[0,:]
+    GammaP[ilead,1,:]=coef[1,:]
+    GammaP[ilead,2,:]=q.copy()
+  if cvfit:
+    ## leave-one-year-out fits from the same sufficient statistics
+    GammaPCV=np.zeros((nyearH,nleadF,3,ngpV),dtype=np.float32)-99999.
+    coef,q = core.gamma_loyo_from_stats(np.moveaxis(GStats,2,1),core.ZeroMax)
+    GammaPCV[:,:,0,:]=coef[:,0,:,:]
+    GammaPCV[:,:,1,:]=coef[:,1,:,:]
+    GammaPCV[:,:,2,:]=q
 
-  #save gamma fit parameters     
-  save_gamma_params(GammaP)
+  ## back to the full grid, missing outside the valid points except the
+  ## frequency of zero: 1 as from the fit of samples without data
+  lout = np.ones(ngpTOT,dtype=bool)
+  lout[ipts] = False
+  def unpack_fit(xp):
+    xx = core.unpack_points(xp,ipts,ngpTOT)
+    xx[...,2,lout] = 1.
+    return xx
+  pdata={'GammaP':unpack_fit(GammaP)}
+  if spimethod == 'empirical':
+    pdata['EClim']=core.unpack_points(EClim,ipts,ngpTOT)
+  if cvfit:
+    pdata['GammaPCV']=unpack_fit(GammaPCV)
+  return pdata
   
-def compute_spi():
+def compute_spi(nproc=1,spimethod='gamma',cvfit=False,outformat='grib',
+                ensprod=False,ensmemb=True):
+  """
+  Compute the SPI of the forecast
+  outformat: grib, chunks or both (see OUTFORMAT)
+  ensprod: also write the ensemble products per lead time (see ens_products)
+  ensmemb: write the member-level grib file
+  """
   ##===================================
   ## 1. Load monitoring 
-  mon_hindF,mon_keys = core.load_grb_file("%s/%s.grb"%(AWDIR,MONHTAG),
-                                        retKeys=['year','month'],verbose=False)
+  mon_hindF,mon_keys = core.moncache.load_mon_hind("%s/%s.grb"%(AWDIR,MONHTAG),
+                                                verbose=False)
   ## Set precip values bellow threshold to zero
   mon_hindF[mon_hindF< core.PminDAY ] = 0. 
   ntHIND,ngpTOT = mon_hindF.shape
@@ -169,42 +368,130 @@ def compute_spi():
   ### 3. Load Gamma Coefs
   GammaP=np.zeros((nleadF,3,ngpTOT),dtype=np.float32)-99999.
   ftags={0:'acoef',1:'bcoef',2:'pzero'}
-  for ik in range(3): # loop on the 3 parameters 
-    fname="%s/GFIT_SPI%i_%s_%s_%s_%02i.grb"%(AWDIR,tscale,ftags[ik],FTYPE,FORTYPE,fmon)
-    xtmp,xkeys = core.load_grb_file(fname,retKeys=['year','month'],verbose=True)
-    GammaP[:,ik,:] = xtmp
-    
+  if spimethod == 'empirical':
+    EClim,GammaP[:,2,:] = core.load_emp_clim(emp_clim_fname())
+  else:
+    for ik in range(3): # loop on the 3 parameters 
+      fname=gfit_fname(ftags[ik],fyear if cvfit else None)
+      xtmp,xkeys = core.load_grb_file(fname,retKeys=['year','month'],verbose=True)
+      GammaP[:,ik,:] = xtmp
+
+  ## Work on the grid points present in the forecast (bitmap) with a valid
+  ## fit for some lead time, the monitoring data only enter the
+  ## accumulations of the leads shorter than tscale
+  if spimethod == 'empirical':
+    lfit = np.any(~np.isnan(EClim[:,0,:]),axis=0)
+  else:
+    lfit = np.any((GammaP[:,2,:] <= core.ZeroMax) & ~np.isnan(GammaP[:,1,:]),axis=0)
+  ipts = np.intersect1d(core.valid_points(for_hind.reshape(-1,ngpTOT)),np.nonzero(lfit)[0])
+  for_hind = for_hind[...,ipts]
+  mon_hindF = mon_hindF[:,ipts]
+  GammaP = GammaP[:,:,ipts]
+  if spimethod == 'empirical':
+    EClim = EClim[:,:,ipts]
+
+  accF,accM=acc_prep(for_hind,mon_hindF,tscale,for_keys['forLead'],kidia,kfdia,
+                     mon_rows=[mon_end_index(fyear,fmon,mon_keys)-1])
 
   ##=======================================
   # Main loop on lead time and write output 
   FTEMPLATE=core.gen_for_fname(AWDIR,FTYPE,SEASVER,YMD,FORTYPE)
   FOUTSPI=core.gen_for_fname(AWDIR,'SPI_%i_'%tscale,FTYPE,YMD,FORTYPE)
-  fin = open(FTEMPLATE)
-  fout = open(FOUTSPI,'w')
-  print('Template from:',FTEMPLATE)
-  print('Writting to:',FOUTSPI)
-  for ilead,fclead in enumerate(for_keys['forLead']):
-    print('Computing/writing lead time',fclead)
-    xprecA = acc_precip(fyear,fmon,fclead,tscale,for_keys,for_hind,mon_keys,mon_hindF,
-                                  kidia,kfdia,verbose=True)
-    xspi = core.fspi_eval(xprecA,core.ZeroMax,
-                        GammaP[ilead,0:2,:],GammaP[ilead,2,:])
-    for imemb in range(nens):
-      gid = ec.codes_grib_new_from_file(fin)
-      fM = ec.codes_get(gid,'forecastMonth')
-      eM = ec.codes_get(gid,'number')
-      #print(ilead,imemb,fM,eM)
-      clone_id = ec.codes_clone(gid)
-      xdata = np.ma.filled(np.ma.fix_invalid(xspi[imemb,:]),core.ZMISS)
-      ec.codes_set(clone_id,'bitsPerValue',12)
-      ec.codes_set(clone_id,'bitmapPresent',1)
-      ec.codes_set(clone_id,'missingValue',core.ZMISS)
-      ec.codes_set_values(clone_id, xdata)
-      ec.codes_write(clone_id, fout)
-      ec.codes_release(clone_id)
-      ec.codes_release(gid)
-  fin.close()
-  fout.close()
+  lgrib = outformat in ('grib','both') and ensmemb
+  if lgrib or ensprod:
+    print('Template from:',FTEMPLATE)
+  if lgrib:
+    print('Writting to:',FOUTSPI)
+  store = None
+  if outformat in ('chunks','both'):
+    ## chunked store (lead,member,gridpoint), written once all leads are done
+    store = core.chunkstore.create(core.chunkstore.store_fname(FOUTSPI),(nens,ngpTOT),
+                                   coords={'member':for_keys['forENB']},
+                                   attrs={'tscale':tscale,'method':spimethod,'YMD':YMD,
+                                          'FTYPE':FTYPE,'FORTYPE':FORTYPE})
+    print('Writting to:',store.path)
+
+  tmplP = [] # template (first member) of each lead time for the products
+  xstore = [] # SPI of each lead time for the chunked store
+  xprod = [] # ensemble products of each lead time
+  def spi_jobs():
+    fin = open(FTEMPLATE,'rb')
+    for ilead,fclead in enumerate(for_keys['forLead']):
+      print('Computing/writing lead time',fclead)
+      xprecA = acc_precip(fyear,fmon,fclead,tscale,for_keys,accF,mon_keys,accM,
+                                    verbose=True)
+      ## evaluate only where this lead time has a valid fit
+      if spimethod == 'empirical':
+        ieval = np.nonzero(~np.isnan(EClim[ilead,0,:]))[0]
+      else:
+        ieval = np.nonzero((GammaP[ilead,2,:] <= core.ZeroMax) &
+                           ~np.isnan(GammaP[ilead,1,:]))[0]
+      xspi = np.zeros((nens,ngpTOT),dtype=np.float32)*np.nan
+      if spimethod == 'empirical':
+        xspi[:,ipts[ieval]] = core.fspi_emp_eval(xprecA[:,ieval],EClim[ilead][:,ieval])
+      else:
+        xspi[:,ipts[ieval]] = core.fspi_eval(xprecA[:,ieval],core.ZeroMax,
+                            GammaP[ilead,0:2][:,ieval],GammaP[ilead,2,ieval])
+      if store is not None:
+        xstore.append(xspi)
+      if ensprod:
+        xmean,xprob,xperc = core.ens_summary(xspi)
+        xprod.append(np.concatenate(([xmean],xprob,xperc)))
+      if not (lgrib or ensprod):
+        continue
+      for imemb in range(nens):
+        gid = ec.codes_grib_new_from_file(fin)
+        msg = core.grbio.get_message(gid)
+        ec.codes_release(gid)
+        if imemb == 0:
+          tmplP.append(msg)
+        if lgrib:
+          yield msg,core.grbio.SPI_KEYS,xspi[imemb,:]
+    fin.close()
+
+  if lgrib:
+    fout = open(FOUTSPI,'wb')
+    core.grbio.write_messages(fout,spi_jobs(),nproc)
+    fout.close()
+  else:
+    for job in spi_jobs():
+      pass
+  if store is not None:
+    store.append(np.array(xstore),[int(fclead) for fclead in for_keys['forLead']])
+
+  if ensprod:
+    ens_products(tmplP,np.array(xprod),for_keys['forLead'])
+
+def ens_products(templates,xprod,leads):
+  """
+  Write the ensemble products of the forecast SPI, one file per product
+  and lead time (*_<TAG>_Lnn.grb, TAG from ens_product_tags) holding a
+  single field, so that no grib key (e.g. number) is reused to tell them
+  apart:
+   MEAN: ensemble mean
+   PBnn: fraction of members below each core.SPI_DROUGHT threshold
+   PCnn: the core.SPI_PERCENTILES percentiles
+  templates: encoded message of each lead time
+  xprod: np.array (nlead,nprod,ngp) as returned by core.ens_summary
+  leads: forecast month of each lead time
+  """
+  ptags = ens_product_tags()
+  for il,fclead in enumerate(leads):
+    for ik,ptag in enumerate(ptags):
+      FOUTP=core.gen_for_fname(AWDIR,'SPI_%i_'%tscale,FTYPE,YMD,'%s_%s_L%02i'%(FORTYPE,ptag,fclead))
+      fout = open(FOUTP,'wb')
+      core.grbio.write_messages(fout,[(templates[il],core.grbio.SPI_KEYS,xprod[il,ik,:])])
+      fout.close()
+    print('Ensemble products of lead time',fclead,'written to:',
+          core.gen_for_fname(AWDIR,'SPI_%i_'%tscale,FTYPE,YMD,'%s_*_L%02i'%(FORTYPE,fclead)))
+
+def ens_product_tags():
+  """
+  Name of each ensemble product, in the order of core.ens_summary: MEAN,
+  PB10 (SPI<-1), PB15, PB20, PC10 (10th percentile), PC50, PC90
+  """
+  return (['MEAN']+['PB%02i'%int(round(-thr*10)) for thr in core.SPI_DROUGHT]+
+          ['PC%02i'%int(round(perc)) for perc in core.SPI_PERCENTILES])
 
 
 def main(args=None):
@@ -213,6 +500,37 @@ def main(args=None):
   ## Get required variables 
   OPT=core.get_opt(['AWDIR','SPITSCALE','HINDYSTART','HINDYEND','FORTYPE','SEASVER','YMD','CONFIG','FTYPE'],args[1:])
   print(OPT)
+  ## Optional settings:
+  ##  NPROC: number of processes used for grib encoding
+  ##  PROFILE: write a json run report (timings, memory, i/o) to this file
+  ##  SPIMETHOD: gamma (default) or empirical (Gringorten plotting positions)
+  ##  CVFIT: 1 to also fit (fit_hind) and use (compute_spi) leave-one-year-out
+  ##         gamma parameters, GFIT_*_CVyyyy.grb files
+  ##  PCACHE: directory of the fitted parameters cache (disabled if not set)
+  ##  PCACHEMAX: maximum size of the parameters cache in MB
+  ##  CKPTDIR: scratch directory to checkpoint fit_hind after each hindcast
+  ##           year, a restarted run resumes from it (disabled if not set)
+  ##  OUTFORMAT: compute_spi output, grib (default), chunks (chunked array
+  ##             store SPI_*.spic) or both
+  ##  ENSPROD: 1 to also write the ensemble mean, drought probabilities and
+  ##           percentiles, one file per product and lead time (compute_spi)
+  ##  ENSMEMB: 0 to skip the member-level SPI grib file (compute_spi)
+  OPTO=core.get_opt(['NPROC','PROFILE','SPIMETHOD','CVFIT','PCACHE','PCACHEMAX','CKPTDIR',
+                     'OUTFORMAT','ENSPROD','ENSMEMB'],args[1:])
+  nproc=int(OPTO['NPROC'] or 1)
+  spimethod=OPTO['SPIMETHOD'] or 'gamma'
+  if spimethod not in ('gamma','empirical'):
+    print('SPI method not available!',spimethod)
+    sys.exit(-1)
+  outformat=OPTO['OUTFORMAT'] or 'grib'
+  if outformat not in ('grib','chunks','both'):
+    print('Output format not available!',outformat)
+    sys.exit(-1)
+  cvfit=int(OPTO['CVFIT'] or 0) == 1
+  if cvfit and spimethod != 'gamma':
+    print('CVFIT is only available with SPIMETHOD=gamma')
+    sys.exit(-1)
+  core.instrument.start(OPTO['PROFILE'],'spidi-spi-for')
   for key in OPT.keys():
     if OPT[key] is None:
       print('Variable: ',key,' is not defined')
@@ -221,12 +539,14 @@ def main(args=None):
       print('Exiting')
       #sys.exit(-1)
     else:
-      exec(key+'="'+OPT[key]+'"')
+      globals()[key]=OPT[key]
 
   # testing: run calc_spi_for.py  --AWDIR=/disk1/data/work/dsuite/20160101/ --SPITSCALE=6 --HINDYEND=2016 --HINDYSTART=2007 --FORTYPE=ENS --SEASVER=5 --YMD=20160101 --CONFIG=fit_hind 
   #          run calc_spi_for.py  --AWDIR=/disk1/data/work/dsuite/20160101/ --SPITSCALE=6 --HINDYEND=2016 --HINDYSTART=2007 --FORTYPE=ENS --SEASVER=5 --YMD=20160101 --CONFIG=compute_spi
 
-  ## generic / computed variables used at some point 
+  ## generic / computed variables used at some point (module variables
+  ## read by the functions above)
+  global MONHTAG,tscale,ystartH,yendH,nyearH,fmon,fyear
   MONHTAG=core.MONHTAG
   tscale=int(SPITSCALE)
 
@@ -235,22 +555,24 @@ def main(args=None):
   nyearH=yendH-ystartH+1
   fmon=int(YMD[4:6]) # Forecast start Month
   fyear=int(YMD[0:4])
+  if cvfit and CONFIG == 'compute_spi' and not (ystartH <= fyear <= yendH):
+    ## the leave-one-year-out parameters only exist for the hindcast years,
+    ## a forecast outside the hindcast period is not in the full sample fit
+    print('CVFIT: forecast year',fyear,'outside the hindcast period',ystartH,'-',yendH,
+          ', using the full sample fit')
+    cvfit=False
 
-  # max number of points nproma to avoid using too much RAM memory 
-  npMAX=500000  
-  if FORTYPE == "ENS":
-    npMAX=50000
-  if FORTYPE == "ENM":
-    npMAX=500000
-    
-    
   if ( CONFIG == 'fit_hind') : 
-    fit_hind()      
+    pcache=core.pcache.open_cache(OPTO['PCACHE'],OPTO['PCACHEMAX'] and float(OPTO['PCACHEMAX']))
+    fit_hind(spimethod,cvfit,pcache,OPTO['CKPTDIR'])
   elif (CONFIG == 'compute_spi'):
-    compute_spi()
+    compute_spi(nproc,spimethod,cvfit,outformat,
+                ensprod=int(OPTO['ENSPROD'] or 0) == 1,
+                ensmemb=int(OPTO['ENSMEMB'] or 1) == 1)
   else:
     print('Configuration requested not available!',CONFIG)
     sys.exit(-1)
+  core.instrument.finish()
 
 
 if __name__ == "__main__":
@@ -13,9 +13,10 @@ import eccodes as ec
 
 from spidi import core
 
-def save_gamma_params():
+@core.instrument.timed('save_gamma_params')
+def save_gamma_params(GammaP):
   FTEMPLATE="%s/%s.grb"%(AWDIR,MONHTAG)
-  fin = open(FTEMPLATE)
+  fin = open(FTEMPLATE,'rb')
   gid = ec.codes_grib_new_from_file(fin)
   clone_id = ec.codes_clone(gid)
   ec.codes_release(gid)
@@ -26,14 +27,15 @@ def save_gamma_params():
   for ik in range(3): # loop on the 3 parameters 
     fnameOUT="%s/GFIT_SPI%i_%s_%s.grb"%(AWDIR,tscale,ftags[ik],MONHTAG)
     print("Writing to output:",fnameOUT)
-    fout = open(fnameOUT,'w')
+    fout = open(fnameOUT,'wb')
     for im in range(12):
       xtmp = np.ma.filled(np.ma.fix_invalid(GammaP[ik,im,:]),core.ZMISS)
       ec.codes_set_values(clone_id,xtmp)
       ec.codes_set(clone_id,'dataDate',int("2016%02i01"%(im+1)))
       ec.codes_write(clone_id, fout)
+    fout.close()
+    core.instrument.count_io(fnameOUT,'write',12)
   ec.codes_release(clone_id)
-  fout.close()
   return
 
 def main(args=None):
@@ -41,6 +43,36 @@ def main(args=None):
   ## Get required variables 
   OPT=core.get_opt(['AWDIR','SPITSCALE','HINDYSTART','HINDYEND'],args[1:])
   print(OPT)
+  ## Optional settings:
+  ##  NPROC: number of processes used for grib encoding
+  ##  NTHREADS: number of threads for the gamma fit and transform (see
+  ##            core.indices)
+  ##  PROFILE: write a json run report (timings, memory, i/o) to this file
+  ##  SPIMETHOD: gamma (default) or empirical (Gringorten plotting positions)
+  ##  PCACHE: directory of the fitted parameters cache (disabled if not set)
+  ##  PCACHEMAX: maximum size of the parameters cache in MB
+  ##  OUTFORMAT: grib (default), chunks (chunked array store SPI*.spic, new
+  ##             months appended to an existing store) or both
+  ##  NBOOT: number of bootstrap replicates of the gamma fit (default 0: no
+  ##         bootstrap), writes the parameter percentiles (GBOOT_SPI*.npz)
+  ##         and SPI percentile fields (SPI*_Pnn.grb)
+  OPTO=core.get_opt(['NPROC','NTHREADS','PROFILE','SPIMETHOD','PCACHE','PCACHEMAX',
+                     'OUTFORMAT','NBOOT'],args[1:])
+  nproc=int(OPTO['NPROC'] or 1)
+  nthreads=int(OPTO['NTHREADS'] or 1)
+  spimethod=OPTO['SPIMETHOD'] or 'gamma'
+  if spimethod not in ('gamma','empirical'):
+    print('SPI method not available!',spimethod)
+    sys.exit(-1)
+  nboot=int(OPTO['NBOOT'] or 0)
+  if nboot > 0 and spimethod != 'gamma':
+    print('NBOOT is only available with SPIMETHOD=gamma')
+    sys.exit(-1)
+  outformat=OPTO['OUTFORMAT'] or 'grib'
+  if outformat not in ('grib','chunks','both'):
+    print('Output format not available!',outformat)
+    sys.exit(-1)
+  core.instrument.start(OPTO['PROFILE'],'spidi-spi-mon')
   for key in OPT.keys():
     if OPT[key] is None:
       print('Variable: ',key,' is not defined')
@@ -49,11 +81,13 @@ def main(args=None):
       print('Exiting')
       #sys.exit(-1)
     else:
-      exec(key+'="'+OPT[key]+'"')
+      globals()[key]=OPT[key]
 
 
   # testing: run calc_spi_mon.py  --AWDIR=/disk1/data/work/dsuite/20160101/ --SPITSCALE=6 --HINDYEND=2016 --HINDYSTART=2007
 
+  ## module variables also used by save_gamma_params
+  global MONHTAG,tscale
   MONHTAG=core.MONHTAG
   tscale=int(SPITSCALE)
 
@@ -61,7 +95,7 @@ def main(args=None):
   ##=====================================
   ## Load MON HIND data 
   fnameMON="%s/%s.grb"%(AWDIR,MONHTAG) 
-  mon_hindP,mon_keys = core.load_grb_file(fnameMON,retKeys=['year','month'],verbose=True)
+  mon_hindP,mon_keys = core.moncache.load_mon_hind(fnameMON,verbose=True)
   #mon_hindT=np.array([dt.datetime(yr,mon,1) for yr,mon in zip(mon_keys['year'],mon_keys['month'])])
   ntTOT,ngpTOT = mon_hindP.shape
   months_hind=np.array(mon_keys['month'])
@@ -69,59 +103,134 @@ def main(args=None):
 
   ## Set precip values bellow threshold to zero
   mon_hindP[mon_hindP< core.PminDAY ] = 0. 
+  ## Work on the grid points present in the bitmap only
+  ipts = core.valid_points(mon_hindP)
+  mon_hindP = mon_hindP[:,ipts]
+  ngpV = len(ipts)
+  print('Valid grid points:',ngpV,'of',ngpTOT)
   ## Accumulate precipitation for the specific time scale 
-  xpreA=core.rolling_sum(mon_hindP,n=tscale,axis=0).astype(np.float32)
+  xpreA=core.indices.accumulate(['spi'],{'precip':mon_hindP},tscale)['precip']
   months_hind[0:tscale-1]=9999  # set strange months in the beggining of accumulation so that the "nan" are not included in the fit 
-
-  ## Do the fitting to the gamma function 
-  GammaP=np.zeros((3,12,ngpTOT),dtype=np.float32) # Acoef,Bcoef,pzero
-
-  for im in range(12):
-    ttind = np.nonzero((months_hind == im+1) &
-                      (years_hind >= int(HINDYSTART))&
-                      (years_hind <= int(HINDYEND)) )[0]
-    print('Fitting:tscale,month,samples:',tscale,im+1,len(ttind))
-    xdata = xpreA[ttind,:]
-    coef,q = core.fspi_fit(xdata,core.ZeroMax,-1)
-    GammaP[0,im,:]=coef[0,:]
-    GammaP[1,im,:]=coef[1,:]
-    GammaP[2,im,:]=q.copy()
+  ## Drop the (arid) points with a frequency of zero above ZeroMax in the
+  ## fit samples of every calendar month: no valid fit, missing SPI
+  lfit = (months_hind <= 12) & (years_hind >= int(HINDYSTART)) & (years_hind <= int(HINDYEND))
+  ikeep = core.valid_points(xpreA[lfit,:],core.ZeroMax,months_hind[lfit])
+  ipts = ipts[ikeep]
+  xpreA = xpreA[:,ikeep]
+  ngpV = len(ipts)
+  print('Grid points passing the zero frequency test:',ngpV)
+
+  ## Parameters of an identical previous fit (optional cache)
+  pcache=core.pcache.open_cache(OPTO['PCACHE'],OPTO['PCACHEMAX'] and float(OPTO['PCACHEMAX']))
+  pdata=None
+  if pcache is not None:
+    pkey=core.pcache.cache_key([core.moncache.source_fname(fnameMON)],
+                               {'entry':'spi-mon','tscale':tscale,
+                                'hindystart':int(HINDYSTART),'hindyend':int(HINDYEND),
+                                'method':spimethod,'PminDAY':core.PminDAY,'ZeroMax':core.ZeroMax})
+    pdata=pcache.get(pkey)
+
+  ## Do the fitting to the gamma function (or empirical climatology)
+  if pdata is not None:
+    GammaP=pdata['GammaP'][:,:,ipts]
+    if spimethod == 'empirical':
+      EClim=pdata['EClim'][:,:,ipts]
+  if spimethod == 'gamma':
+    ## gamma fit (unless cached) and SPI with the index engine
+    lfitH = (years_hind >= int(HINDYSTART)) & (years_hind <= int(HINDYEND))
+    xspi,GammaP = core.indices.compute_indices(['spi'],None,tscale,months_hind,lfitH,nthreads,
+                                               acc={'precip':xpreA},
+                                               params=None if pdata is None else
+                                                      {'spi':np.swapaxes(GammaP,0,1)})['spi']
+    GammaP = np.swapaxes(GammaP,0,1) # Acoef,Bcoef,pzero
+  elif pdata is None:
+    GammaP=np.zeros((3,12,ngpV),dtype=np.float32) # pzero only
+    nsamp=np.max([np.sum((months_hind == im+1) & (years_hind >= int(HINDYSTART)) &
+                         (years_hind <= int(HINDYEND))) for im in range(12)])
+    EClim=np.zeros((12,nsamp,ngpV),dtype=np.float32)*np.nan
+    for im in range(12):
+      ttind = np.nonzero((months_hind == im+1) &
+                        (years_hind >= int(HINDYSTART))&
+                        (years_hind <= int(HINDYEND)) )[0]
+      print('Fitting:tscale,month,samples:',tscale,im+1,len(ttind))
+      EClim[im,0:len(ttind),:],GammaP[2,im,:] = core.fspi_emp_fit(xpreA[ttind,:],core.ZeroMax)
+  if pdata is None and pcache is not None:
+    if spimethod == 'empirical':
+      pcache.put(pkey,GammaP=core.unpack_points(GammaP,ipts,ngpTOT),
+                 EClim=core.unpack_points(EClim,ipts,ngpTOT))
+    else:
+      pcache.put(pkey,GammaP=core.unpack_points(GammaP,ipts,ngpTOT))
 
   ## save fitting parameters 
-  save_gamma_params() 
-
-  ## Apply transformation to spi 
-  xspi = np.zeros(xpreA.shape,dtype=np.float32)
-  ## loop on months
-  for im in range(12):
-    ttind = np.nonzero(months_hind == im+1)[0]
-    xspi[ttind,:] = core.fspi_eval(xpreA[ttind,:],core.ZeroMax,
-                                GammaP[0:2,im,:],GammaP[2,im,:])
-    print("Computing SPI,tscale,calendar month:",tscale,im+1)
+  if spimethod == 'empirical':
+    core.save_emp_clim("%s/ECLIM_SPI%i_%s.npz"%(AWDIR,tscale,MONHTAG),
+                       core.unpack_points(EClim,ipts,ngpTOT),
+                       core.unpack_points(GammaP[2,:,:],ipts,ngpTOT))
+  else:
+    save_gamma_params(core.unpack_points(GammaP,ipts,ngpTOT)) 
+
+  ## Apply the empirical transformation to spi, only on points with a valid
+  ## climatology in some month
+  if spimethod == 'empirical':
+    ieval = np.nonzero(np.any(~np.isnan(EClim[:,0,:]),axis=0))[0]
+    xspi = np.zeros(xpreA.shape,dtype=np.float32)*np.nan
+    ## loop on months
+    for im in range(12):
+      ttind = np.nonzero(months_hind == im+1)[0]
+      xspi[np.ix_(ttind,ieval)] = core.fspi_emp_eval(xpreA[np.ix_(ttind,ieval)],EClim[im][:,ieval])
+      print("Computing SPI,tscale,calendar month:",tscale,im+1)
+  xspi = core.unpack_points(xspi,ipts,ngpTOT)
 
   ## write spi to output file (copy from precip...)
   FTEMPLATE="%s/%s.grb"%(AWDIR,MONHTAG)
   FOUTSPI="%s/SPI%i_%s.grb"%(AWDIR,tscale,MONHTAG)
-  fin = open(FTEMPLATE)
-  fout = open(FOUTSPI,'w')
-  ikfld=0
-  while 1:
-    gid = ec.codes_grib_new_from_file(fin)
-    if gid is None:
-      break
-    clone_id = ec.codes_clone(gid)
-    ec.codes_set(clone_id,'bitsPerValue',12)
-    ec.codes_set(clone_id,'bitmapPresent',1)
-    ec.codes_set(clone_id,'missingValue',core.ZMISS)
-    xtmp = np.ma.filled(np.ma.fix_invalid(xspi[ikfld,:]),core.ZMISS)
-    ec.codes_set_values(clone_id, xtmp)
-    ec.codes_write(clone_id, fout)
-    ec.codes_release(clone_id)
-    ec.codes_release(gid)
-    ikfld=ikfld+1
-  fin.close()
-  fout.close()
-  print(ikfld,' fields written to:',FOUTSPI)    
+  if outformat in ('grib','both'):
+    fout = open(FOUTSPI,'wb')
+    ikfld = core.grbio.write_messages(fout,core.grbio.file_jobs(FTEMPLATE,xspi),nproc)
+    fout.close()
+    print(ikfld,' fields written to:',FOUTSPI)    
+  if outformat in ('chunks','both'):
+    ## chunked store with time coordinate yyyymm, only the new months and
+    ## those with a different SPI (revised monitoring data, new fit) are written
+    times = [int(yr*100+mon) for yr,mon in zip(mon_keys['year'],mon_keys['month'])]
+    FSTORE = core.chunkstore.store_fname(FOUTSPI)
+    store,ntold = core.chunkstore.open_append(FSTORE,(ngpTOT,),times,xdata=xspi,
+                                              attrs={'tscale':tscale,'method':spimethod,
+                                                     'hindystart':int(HINDYSTART),
+                                                     'hindyend':int(HINDYEND)})
+    store.append(xspi[ntold:,:],times[ntold:])
+    print(ntTOT-ntold,' months written to:',FSTORE)
+
+  ## Bootstrap uncertainty of the gamma fit: parameters and SPI percentiles
+  if nboot > 0:
+    nperc=len(core.BOOT_PERC)
+    GBoot=np.zeros((nperc,3,12,ngpV),dtype=np.float32) # Acoef,Bcoef,pzero percentiles
+    xspiB=np.zeros((nperc,ntTOT,ngpV),dtype=np.float32)*np.nan
+    for im in range(12):
+      ttind = np.nonzero((months_hind == im+1) &
+                        (years_hind >= int(HINDYSTART))&
+                        (years_hind <= int(HINDYEND)) )[0]
+      ttout = np.nonzero(months_hind == im+1)[0]
+      print('Bootstrap:tscale,month,replicates:',tscale,im+1,nboot)
+      coefp,qp,spip = core.fspi_boot(xpreA[ttind,:],core.ZeroMax,nboot,
+                                     Deval=xpreA[ttout,:],seed=im)
+      GBoot[:,0:2,im,:]=coefp
+      GBoot[:,2,im,:]=qp
+      xspiB[:,ttout,:]=spip
+    FBOOT="%s/GBOOT_SPI%i_%s.npz"%(AWDIR,tscale,MONHTAG)
+    fout = open(FBOOT,'wb')
+    np.savez(fout,GBoot=core.unpack_points(GBoot,ipts,ngpTOT),
+             percentiles=np.array(core.BOOT_PERC),nboot=nboot)
+    fout.close()
+    print("File created:",FBOOT)
+    for iperc,perc in enumerate(core.BOOT_PERC):
+      FOUTB="%s/SPI%i_%s_P%02i.grb"%(AWDIR,tscale,MONHTAG,int(round(perc)))
+      fout = open(FOUTB,'wb')
+      ikfld = core.grbio.write_messages(fout,core.grbio.file_jobs(FTEMPLATE,
+                                        core.unpack_points(xspiB[iperc],ipts,ngpTOT)),nproc)
+      fout.close()
+      print(ikfld,' fields written to:',FOUTB)
+  core.instrument.finish()
 
 
 if __name__ == "__main__":
@@ -46,7 +46,10 @@ def main(args=None):
       print('Exiting')
       sys.exit(-1)
     else:
-      exec(key+'="'+OPT[key]+'"')
+      globals()[key]=OPT[key]
+  ## Optional: write a json run report (timings, memory, i/o) to PROFILE
+  OPTO=core.get_opt(['PROFILE'],args[1:])
+  core.instrument.start(OPTO['PROFILE'],'spidi-cbias-seasonal')
 
   # testing: run cbias_seasonal.py  --AWDIR=/disk1/data/work/dsuite/20160101/ --SEASVER=5 --HINDYEND=2016 --HINDYSTART=2007 --YMD=20160101
 
@@ -87,22 +90,24 @@ def main(args=None):
   FTEMPLATE=core.gen_for_fname(AWDIR,'FOR',SEASVER,YMD,'ENM')
   FOUTMF=core.gen_for_fname(AWDIR,'BCfFOR',SEASVER,YMD[4:6],'ENM')
   print('Writing Mfactor to:',FOUTMF)
-  fin = open(FTEMPLATE)
-  fout = open(FOUTMF,'w')
-  for il in range(nlead):
-    gid = ec.codes_grib_new_from_file(fin)
-    fM = ec.codes_get(gid,'forecastMonth')
-    print(il,fM)
-    clone_id = ec.codes_clone(gid)
-    ec.codes_set(clone_id,'bitmapPresent',1)
-    ec.codes_set(clone_id,'missingValue',core.ZMISS)
-    xtmp = np.ma.filled(np.ma.fix_invalid(mfact[il,:]),core.ZMISS)
-    ec.codes_set_values(clone_id, xtmp)
-    ec.codes_write(clone_id, fout)
-    ec.codes_release(clone_id)
-    ec.codes_release(gid)
-  fin.close()
-  fout.close()
+  with core.instrument.stage('write_mfactor'):
+    fin = open(FTEMPLATE,'rb')
+    fout = open(FOUTMF,'wb')
+    for il in range(nlead):
+      gid = ec.codes_grib_new_from_file(fin)
+      fM = ec.codes_get(gid,'forecastMonth')
+      print(il,fM)
+      clone_id = ec.codes_clone(gid)
+      ec.codes_set(clone_id,'bitmapPresent',1)
+      ec.codes_set(clone_id,'missingValue',core.ZMISS)
+      xtmp = np.ma.filled(np.ma.fix_invalid(mfact[il,:]),core.ZMISS)
+      ec.codes_set_values(clone_id, xtmp)
+      ec.codes_write(clone_id, fout)
+      ec.codes_release(clone_id)
+      ec.codes_release(gid)
+    fin.close()
+    fout.close()
+  core.instrument.count_io(FOUTMF,'write',nlead)
 
 
   ##=========================================
@@ -111,39 +116,52 @@ def main(args=None):
   yend=int(HINDYEND)
   fmon=YMD[4:6]
   ## loop on hindcast years + actual forecast 
-  for yr in np.unique(range(ystart,yend+1)+[int(YMD[0:4])]):
+  for yr in np.unique(list(range(ystart,yend+1))+[int(YMD[0:4])]):
     fdate="%i%s01"%(yr,fmon)
     FTEMPLATE=core.gen_for_fname(AWDIR,'FOR',SEASVER,fdate,'ENS')
     FOUTBC=core.gen_for_fname(AWDIR,'BCFOR',SEASVER,fdate,'ENS')
     print('Processing:',FTEMPLATE)
-    fin = open(FTEMPLATE)
-    fout = open(FOUTBC,'w')
-    ikfld=0
-    while 1:
-      gid = ec.codes_grib_new_from_file(fin)
-      if gid is None:
-        break
-      xdata = ec.codes_get_values(gid)
-      fM = ec.codes_get(gid,'forecastMonth')
-      eM = ec.codes_get(gid,'number')
-
-      # apply correction
-      xdata = xdata*mfact[fM-1,:]
-      clone_id = ec.codes_clone(gid)
-      ec.codes_set(clone_id,'bitmapPresent',1)
-      ec.codes_set(clone_id,'missingValue',core.ZMISS)
-      xtmp = np.ma.filled(np.ma.fix_invalid(xdata),core.ZMISS)
-      ec.codes_set_values(clone_id, xtmp)
-      ec.codes_write(clone_id, fout)
-      ec.codes_release(clone_id)
-      ec.codes_release(gid)
-      ikfld=ikfld+1
-    fin.close()
-    fout.close()
+    with core.instrument.stage('write_bcfor'):
+      fin = open(FTEMPLATE,'rb')
+      fout = open(FOUTBC,'wb')
+      ikfld=0
+      xbc,dD,fMs,eMs = [],[],[],[] # kept for the pipeline memory store
+      while 1:
+        gid = ec.codes_grib_new_from_file(fin)
+        if gid is None:
+          break
+        xdata = ec.codes_get_values(gid)
+        fM = ec.codes_get(gid,'forecastMonth')
+        eM = ec.codes_get(gid,'number')
+
+        # apply correction
+        xdata = xdata*mfact[fM-1,:]
+        clone_id = ec.codes_clone(gid)
+        ec.codes_set(clone_id,'bitmapPresent',1)
+        ec.codes_set(clone_id,'missingValue',core.ZMISS)
+        xtmp = np.ma.filled(np.ma.fix_invalid(xdata),core.ZMISS)
+        ec.codes_set_values(clone_id, xtmp)
+        ec.codes_write(clone_id, fout)
+        if core.memstore.enabled():
+          xbc.append(core.grbio.decode_values(ec.codes_get_message(clone_id)))
+          dD.append(ec.codes_get(gid,'dataDate'))
+          fMs.append(fM)
+          eMs.append(eM)
+        ec.codes_release(clone_id)
+        ec.codes_release(gid)
+        ikfld=ikfld+1
+      fin.close()
+      fout.close()
+    if core.memstore.enabled():
+      core.memstore.put(FOUTBC,['dataDate','forecastMonth','number'],np.array(xbc),
+                        {'dataDate':dD,'forecastMonth':fMs,'number':eMs})
+    core.instrument.count_io(FTEMPLATE,'read',ikfld)
+    core.instrument.count_io(FOUTBC,'write',ikfld)
     print(ikfld,' fields written to:',FOUTBC)
     # compute ensemble mean
     FOUTBCENM=core.gen_for_fname(AWDIR,'BCFOR',SEASVER,fdate,'ENM')
     core.compute_clim(FOUTBC,FOUTBCENM,'forecastMonth')
+  core.instrument.finish()
 
 
 if __name__ == "__main__":
@@ -5,15 +5,41 @@
 from __future__ import print_function
 
 import numpy as np 
+import os
 import sys
 import eccodes as ec 
 from netCDF4 import Dataset,num2date
 import datetime as dt 
-import calendar 
 
 from spidi import core
 
 
+def decode_dates(tvar):
+  """
+  Decode the full time axis of the input file to dates as YYYYMMDD integers
+  """
+  cunits=getattr(tvar,'units')
+  tvals=tvar[:]
+  if "months since" in cunits:
+    xtime=dt.datetime.strptime(cunits.split(' ')[2],"%Y-%m-%d")
+    imon = xtime.year*12+xtime.month-1+np.asarray(tvals).astype(int)
+    cdates = (imon//12)*10000+(np.mod(imon,12)+1)*100+xtime.day
+  elif "since" in cunits:
+    xtime = num2date(tvals,cunits)
+    cdates = np.array([int(xx.strftime("%Y%m%d")) for xx in np.atleast_1d(xtime)])
+  else:
+    cdates = np.asarray(tvals).astype(int)
+  return cdates
+
+def days_in_month(years,months):
+  """
+  Number of days in each (year,month)
+  """
+  imon = (np.asarray(years)-1970)*12+np.asarray(months)-1
+  mstart = imon.astype('datetime64[M]')
+  return ((mstart+1).astype('datetime64[D]')-mstart.astype('datetime64[D]')).astype(int)
+
+
 def main(args=None):
 
   OPT=core.get_opt(['IFILE','OFILE','YMDMIN'],args[1:])
@@ -26,10 +52,30 @@ def main(args=None):
       print('Exiting')
       sys.exit(-1)
     else:
-      exec(key+'="'+OPT[key]+'"')
-  YMDMIN=int(YMDMIN)
+      globals()[key]=OPT[key]
+  YMDMIN=int(OPT['YMDMIN'])
+
+  ## Optional settings:
+  ##  OCACHE: also write the fields to the monitoring cache of OFILE, read
+  ##          instead of decoding OFILE while OFILE is unchanged. It must be
+  ##          OFILE with the .npz extension (e.g. AWDIR/MON_HIND.npz), the
+  ##          only cache file name looked for (core.moncache.cache_fname)
+  ##  NTBLOCK: number of time steps read at once from the input file
+  ##  NPROC: number of processes used for grib encoding
+  ##  PROFILE: write a json run report (timings, memory, i/o) to this file
+  OPTO=core.get_opt(['OCACHE','NTBLOCK','NPROC','PROFILE'],args[1:])
+  OCACHE=OPTO['OCACHE']
+  if OCACHE is not None and ( os.path.abspath(OCACHE) !=
+                              os.path.abspath(core.moncache.cache_fname(OFILE)) ):
+    print('OCACHE must be the cache file of OFILE:',core.moncache.cache_fname(OFILE))
+    print('Exiting')
+    sys.exit(-1)
+  ntblock=int(OPTO['NTBLOCK'] or 120)
+  nproc=int(OPTO['NPROC'] or 1)
+  core.instrument.start(OPTO['PROFILE'],'spidi-gpcc2grib')
 
   #run convGpcc2Grb  --IFILE=tmp.nc --OFILE=tmp.grb --YMDMIN=19790101 
+  #run convGpcc2Grb  --IFILE=tmp.nc --OFILE=MON_HIND.grb --OCACHE=MON_HIND.npz --YMDMIN=19790101 
 
   keys = {
           'dataDate': 19600101,
@@ -63,40 +109,59 @@ def main(args=None):
   nc = Dataset(IFILE,'r')
   ntI = len(nc.dimensions['time'])
   print(ntI)
-  ## prepare grib output      
+
+  ## decode time axis and select the requested period
+  cdates = decode_dates(nc.variables['time'])
+  tind = np.nonzero(cdates >= YMDMIN)[0]
+  cdates = cdates[tind]
+  years = cdates//10000
+  months = np.mod(cdates//100,100)
+  ndays = days_in_month(years,months)
+  nt = len(tind)
+  print('Converting',nt,'time steps',cdates[0] if nt > 0 else '')
+
+  ## prepare grib output
   sample_id = ec.codes_grib_new_from_samples("regular_ll_sfc_grib1")
-  fout = open(OFILE, 'w')
   clone_id = ec.codes_clone(sample_id)
   for key in keys:
     #print(key)
     ec.codes_set(clone_id, key, keys[key])
-    
-  ## loop on time in input file 
-  for ik in range(ntI):
-    cunits=getattr(nc.variables['time'],'units')
-    if "months since" in cunits:
-      xtime=dt.datetime.strptime(cunits.split(' ')[2],"%Y-%m-%d")
-      cdate=int(xtime.strftime("%Y%m%d"))
-    elif "since" in cunits:
-      xtime = num2date(nc.variables['time'][ik],cunits)
-      cdate=int(xtime.strftime("%Y%m%d"))
-    else:
-      cdate=int(nc.variables['time'][ik])
-    if ( cdate < YMDMIN ): continue
-    
-    mon=np.mod(cdate/100,100)
-    yr=cdate/10000
-    xx,ndays=calendar.monthrange(yr,mon)
-    print(yr,mon,ndays)
-    xtmp = np.ma.filled(np.ma.fix_invalid(nc.variables['p'][ik,:,:] / float(ndays)),core.ZMISS)
-    ec.codes_set_values(clone_id,xtmp.ravel())
-    ec.codes_set(clone_id,'dataDate',cdate)
-    
-    ec.codes_write(clone_id, fout)
-    
+  template = core.grbio.get_message(clone_id)
+  ec.codes_release(clone_id)
+  ec.codes_release(sample_id)
+
+  ## keep the fields for the cache file and/or the pipeline memory store,
+  ## as decoded from the written (24 bits packed) messages
+  lkeep = OCACHE is not None or core.memstore.enabled()
+  xkeep = [] if lkeep else None
+
+  def gpcc_jobs():
+    ## loop on contiguous blocks of time steps in input file
+    for ib in range(0,nt,ntblock):
+      ie = np.minimum(ib+ntblock,nt)
+      # split the block where the selected indexes are not contiguous
+      isplit = np.nonzero(np.diff(tind[ib:ie]) != 1)[0]+1
+      for ks,ke in zip(np.concatenate(([0],isplit)),np.concatenate((isplit,[ie-ib]))):
+        ks = ks+ib
+        ke = ke+ib
+        xblk = nc.variables['p'][tind[ks]:tind[ke-1]+1,:,:] / ndays[ks:ke,None,None].astype(np.float32)
+        xblk = np.ma.filled(np.ma.fix_invalid(xblk),np.nan).reshape(ke-ks,-1)
+        for ik in range(ks,ke):
+          print(years[ik],months[ik],ndays[ik])
+          yield template,[('dataDate',int(cdates[ik]))],xblk[ik-ks,:]
+
+  fout = open(OFILE, 'wb')
+  core.grbio.write_messages(fout,gpcc_jobs(),nproc,keep=xkeep)
   fout.close()
   nc.close()
 
+  if lkeep:
+    xcache = np.array(xkeep,dtype=np.float32).reshape(nt,-1)
+  if OCACHE is not None:
+    core.moncache.save_mon_cache(OCACHE,xcache,years,months,FSOURCE=OFILE)
+  if lkeep:
+    core.memstore.put(OFILE,['year','month'],xcache,{'year':years,'month':months})
+  core.instrument.finish()
 
 if __name__ == "__main__":
     main(sys.argv)
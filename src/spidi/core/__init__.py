@@ -1 +1,11 @@
 from . import spi 
+from .spi import *
+from . import grbio
+from . import moncache
+from . import rolling
+from . import instrument
+from . import pcache
+from . import checkpoint
+from . import memstore
+from . import chunkstore
+from . import indices
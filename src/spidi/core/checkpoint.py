@@ -0,0 +1,125 @@
+#
+# Checkpoint of long running accumulations
+#
+# The accumulator arrays are saved to a scratch file after each completed
+# step (e.g. hindcast year) together with the list of steps done, so that
+# a restarted run resumes from there instead of starting again. A json
+# manifest with the same list is written next to it for inspection.
+# Arrays with a part per step are saved in a file per step (save_step),
+# so that each step only writes its own part.
+#
+
+from __future__ import print_function
+
+import glob
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from . import instrument
+
+
+def file_signature(fnames):
+  """
+  Cheap description of the input files (name, size and modification time)
+  used to detect a checkpoint written for different inputs
+  """
+  sig = []
+  for ff in fnames:
+    if os.path.exists(ff):
+      fstat = os.stat(ff)
+      sig.append([os.path.abspath(ff),fstat.st_size,int(fstat.st_mtime)])
+    else:
+      sig.append([os.path.abspath(ff),-1,-1])
+  return sig
+
+
+class Checkpoint(object):
+  """
+  Checkpoint tag in directory cdir
+   signature: dictionary (json serializable) describing the run, a
+              checkpoint with a different signature is ignored
+  """
+  def __init__(self,cdir,tag,signature):
+    self.cdir = cdir
+    self.fdata = os.path.join(cdir,tag+'.npz')
+    self.fmanifest = os.path.join(cdir,tag+'.json')
+    self.signature = json.loads(json.dumps(signature)) # as read back from json
+    if not os.path.isdir(cdir):
+      os.makedirs(cdir)
+
+  def load(self):
+    """
+    Return (done,arrays) from a previous run: list of the completed steps
+    and dictionary of accumulators, ([],{}) if no usable checkpoint
+    """
+    if not os.path.exists(self.fdata):
+      return [],{}
+    with instrument.stage('checkpoint_load'):
+      zz = np.load(self.fdata)
+      manifest = json.loads(str(zz['manifest']))
+      if manifest['signature'] != self.signature:
+        zz.close()
+        print('Checkpoint ignored, written for a different run:',self.fdata)
+        return [],{}
+      arrays = dict((kk,zz[kk]) for kk in zz.files if kk != 'manifest')
+      zz.close()
+    print('Resuming from checkpoint:',self.fdata,'steps done:',manifest['done'])
+    return manifest['done'],arrays
+
+  def step_fname(self,step):
+    return '%s.%s.npz'%(os.path.splitext(self.fdata)[0],step)
+
+  def load_step(self,step):
+    """
+    Return the dictionary of arrays saved for step (one of the steps done
+    returned by load)
+    """
+    with instrument.stage('checkpoint_load'):
+      zz = np.load(self.step_fname(step))
+      arrays = dict((kk,zz[kk]) for kk in zz.files)
+      zz.close()
+    return arrays
+
+  def save_step(self,step,**arrays):
+    """
+    Save the arrays of a single step, before adding it to the steps done
+    with save
+    """
+    with instrument.stage('checkpoint_save'):
+      fd,ftmp = tempfile.mkstemp(dir=self.cdir,suffix='.tmp')
+      fout = os.fdopen(fd,'wb')
+      np.savez(fout,**arrays)
+      fout.close()
+      os.rename(ftmp,self.step_fname(step))
+
+  def save(self,done,**arrays):
+    """
+    Save the accumulators after completing the steps in done
+    The data file holds its own copy of the manifest and is replaced
+    atomically, so an interrupted save leaves the previous checkpoint
+    """
+    manifest = json.dumps({'signature':self.signature,'done':list(done)},
+                          sort_keys=True)
+    with instrument.stage('checkpoint_save'):
+      fd,ftmp = tempfile.mkstemp(dir=self.cdir,suffix='.tmp')
+      fout = os.fdopen(fd,'wb')
+      np.savez(fout,manifest=np.array(manifest),**arrays)
+      fout.close()
+      os.rename(ftmp,self.fdata)
+      fd,ftmp = tempfile.mkstemp(dir=self.cdir,suffix='.tmp')
+      fout = os.fdopen(fd,'w')
+      fout.write(manifest)
+      fout.close()
+      os.rename(ftmp,self.fmanifest)
+
+  def clear(self):
+    """
+    Remove the checkpoint once the run is complete
+    """
+    fsteps = glob.glob(self.step_fname('*'))
+    for ff in [self.fdata,self.fmanifest]+fsteps:
+      if os.path.exists(ff):
+        os.remove(ff)
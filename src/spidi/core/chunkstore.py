@@ -0,0 +1,257 @@
+#
+# Chunked compressed array store (zarr-like) for SPI cubes
+#
+# An array (nt,...,ngp) is stored in a directory as zlib compressed chunks
+# of (chunk time steps,...,chunk grid points), plus a json file with the
+# shape, chunking and coordinates. Reading the time series of a point or
+# region only decompresses the chunks holding those points, and new time
+# steps can be appended without rewriting the existing chunks (only the
+# last one when it is partially filled).
+#
+# Layout of path/:
+#  meta.json : {"shape":[nt,...,ngp],"chunks":[ct,cg],"dtype":"float32",
+#               "level":4,"coords":{"time":[...],...},"attrs":{...},
+#               "digests":[...]}
+#  c.<it>.<ig> : chunk it along time and ig along the grid points, C order
+# digests holds the sha1 of each time step, used by open_append to find
+# the time steps whose content changed.
+#
+
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import tempfile
+import zlib
+
+import numpy as np
+
+from . import instrument
+
+CHUNK_TIME = 12       # default number of time steps per chunk
+CHUNK_POINTS = 4096   # default number of grid points per chunk
+
+
+def _write_atomic(fname,data,mode='wb'):
+  fd,ftmp = tempfile.mkstemp(dir=os.path.dirname(fname),suffix='.tmp')
+  fout = os.fdopen(fd,mode)
+  fout.write(data)
+  fout.close()
+  os.rename(ftmp,fname)
+
+
+class ChunkStore(object):
+  """
+  Chunked array store in directory path (see create to make a new one)
+  """
+  def __init__(self,path):
+    self.path = path
+    fin = open(os.path.join(path,'meta.json'))
+    self.meta = json.load(fin)
+    fin.close()
+    self.meta.setdefault('digests',[None]*self.meta['shape'][0])
+    self.dtype = np.dtype(self.meta['dtype'])
+
+  @property
+  def shape(self):
+    return tuple(self.meta['shape'])
+
+  @property
+  def coords(self):
+    return self.meta['coords']
+
+  @property
+  def attrs(self):
+    return self.meta['attrs']
+
+  def _chunk_fname(self,it,ig):
+    return os.path.join(self.path,'c.%i.%i'%(it,ig))
+
+  def _chunk_shape(self,it,ig,nt=None):
+    ct,cg = self.meta['chunks']
+    shape = self.shape
+    nt = shape[0] if nt is None else nt
+    return ((min(ct,nt-it*ct),)+shape[1:-1]+
+            (min(cg,shape[-1]-ig*cg),))
+
+  def read_chunk(self,it,ig):
+    """
+    Chunk (it,ig), filled with nan if not written
+    """
+    shape = self._chunk_shape(it,ig)
+    fname = self._chunk_fname(it,ig)
+    if not os.path.exists(fname):
+      return np.zeros(shape,dtype=self.dtype)*np.nan
+    fin = open(fname,'rb')
+    buf = fin.read()
+    fin.close()
+    instrument.count_io(fname,'read',1,len(buf))
+    xchunk = np.frombuffer(zlib.decompress(buf),dtype=self.dtype)
+    return xchunk.reshape((-1,)+shape[1:])[0:shape[0],...]
+
+  def write_chunk(self,it,ig,xdata):
+    fname = self._chunk_fname(it,ig)
+    buf = zlib.compress(np.ascontiguousarray(xdata,dtype=self.dtype).tobytes(),
+                        self.meta['level'])
+    _write_atomic(fname,buf)
+    instrument.count_io(fname,'write',1,len(buf))
+
+  @instrument.timed('chunkstore_append')
+  def append(self,xdata,times):
+    """
+    Append time steps to the store
+     xdata: np.array (nt_new,...,ngp)
+     times: time coordinate of each new time step
+    """
+    xdata = np.asarray(xdata)
+    assert xdata.shape[1:] == self.shape[1:], "Array shape does not match the store"
+    assert len(times) == xdata.shape[0], "One time coordinate per time step"
+    ct,cg = self.meta['chunks']
+    ngp = self.shape[-1]
+    nt0 = self.shape[0]
+    nt1 = nt0+xdata.shape[0]
+    for it in range(nt0//ct,(nt1-1)//ct+1):
+      t0 = max(it*ct,nt0)
+      t1 = min((it+1)*ct,nt1)
+      for ig in range(0,(ngp-1)//cg+1):
+        xchunk = np.zeros(self._chunk_shape(it,ig,nt1),dtype=self.dtype)*np.nan
+        if t0 > it*ct: # partially filled chunk
+          xchunk[0:t0-it*ct,...] = self.read_chunk(it,ig)
+        xchunk[t0-it*ct:t1-it*ct,...] = xdata[t0-nt0:t1-nt0,...,ig*cg:(ig+1)*cg]
+        self.write_chunk(it,ig,xchunk)
+    ## metadata last: an interrupted append leaves the previous content
+    self.meta['shape'][0] = nt1
+    self.meta['coords']['time'] = list(self.meta['coords']['time'])+[_jsonable(tt) for tt in times]
+    self.meta['digests'] = list(self.meta['digests'])+[_digest(xx,self.dtype) for xx in xdata]
+    _write_atomic(os.path.join(self.path,'meta.json'),json.dumps(self.meta),'w')
+
+  def truncate(self,nt):
+    """
+    Keep only the first nt time steps
+    """
+    ct,cg = self.meta['chunks']
+    ngp = self.shape[-1]
+    nt0 = self.shape[0]
+    if nt >= nt0:
+      return
+    ## the rows after nt in a partially kept chunk are ignored when reading
+    ## and overwritten by the next append
+    self.meta['shape'][0] = nt
+    self.meta['coords']['time'] = list(self.meta['coords']['time'])[0:nt]
+    self.meta['digests'] = list(self.meta['digests'])[0:nt]
+    _write_atomic(os.path.join(self.path,'meta.json'),json.dumps(self.meta),'w')
+    for it in range((nt-1)//ct+1 if nt > 0 else 0,(nt0-1)//ct+1):
+      for ig in range(0,(ngp-1)//cg+1):
+        if os.path.exists(self._chunk_fname(it,ig)):
+          os.remove(self._chunk_fname(it,ig))
+
+  @instrument.timed('chunkstore_read')
+  def read(self,tind=slice(None),points=None):
+    """
+    Read a subset of the store
+     tind: slice of time steps
+     points: np.array with the index of the grid points (default: all)
+    returns np.array (nt_sel,...,npoints)
+    """
+    ct,cg = self.meta['chunks']
+    nt = self.shape[0]
+    t0,t1,tstep = tind.indices(nt)
+    assert tstep == 1, "Only contiguous time slices are supported"
+    if points is None:
+      points = np.arange(self.shape[-1])
+    points = np.atleast_1d(np.asarray(points))
+    out = np.zeros((max(0,t1-t0),)+self.shape[1:-1]+(len(points),),dtype=self.dtype)
+    gchunk = points//cg
+    for ig in np.unique(gchunk):
+      isel = np.nonzero(gchunk == ig)[0]
+      for it in range(t0//ct,(max(t0,t1-1))//ct+1):
+        if t1 <= t0:
+          break
+        xchunk = self.read_chunk(it,ig)
+        k0 = max(t0,it*ct)
+        k1 = min(t1,(it+1)*ct)
+        out[k0-t0:k1-t0,...,isel] = xchunk[k0-it*ct:k1-it*ct,...,points[isel]-ig*cg]
+    return out
+
+  def point_series(self,ip):
+    """
+    Full time series of grid point ip, np.array (nt,...)
+    """
+    return self.read(points=[ip])[...,0]
+
+
+def _digest(xstep,dtype):
+  return hashlib.sha1(np.ascontiguousarray(xstep,dtype=dtype).tobytes()).hexdigest()
+
+
+def _jsonable(value):
+  if isinstance(value,np.generic):
+    return value.item()
+  return value
+
+
+def create(path,shape,chunks=None,dtype='float32',coords=None,attrs=None,level=4):
+  """
+  Create an empty store (no time steps) for arrays (nt,)+shape
+   shape: shape without the time dimension, the last one being the grid points
+   chunks: (time steps,grid points) per chunk
+   coords: dictionary of coordinates (lists), e.g. {'lead':[1,2,..]},
+           the time coordinate is filled by append
+   attrs: dictionary with extra metadata
+  Any previous store in path is removed
+  """
+  if chunks is None:
+    chunks = (CHUNK_TIME,CHUNK_POINTS)
+  if os.path.isdir(path):
+    for ff in os.listdir(path):
+      if ff == 'meta.json' or ff.startswith('c.'):
+        os.remove(os.path.join(path,ff))
+  else:
+    os.makedirs(path)
+  coords = dict(coords or {})
+  coords['time'] = []
+  meta = {'shape':[0]+[int(nn) for nn in shape],
+          'chunks':[int(nn) for nn in chunks],
+          'dtype':np.dtype(dtype).name,
+          'level':int(level),
+          'coords':dict((kk,[_jsonable(vv) for vv in coords[kk]]) for kk in coords),
+          'attrs':attrs or {},
+          'digests':[]}
+  _write_atomic(os.path.join(path,'meta.json'),json.dumps(meta),'w')
+  return ChunkStore(path)
+
+
+def open_append(path,shape,times,xdata=None,**kwargs):
+  """
+  Open the store in path to append the time steps after times[0:nt] when
+  its shape and attrs match and its time coordinate is a prefix of times,
+  create a new store otherwise (kwargs as create)
+  xdata: np.array (len(times),...,ngp), full content to be stored (if
+         given): the time steps stored with a different content (e.g.
+         revised input data) are removed, to be appended again
+  returns the store and the number of time steps kept in it
+  """
+  if os.path.exists(os.path.join(path,'meta.json')):
+    store = ChunkStore(path)
+    told = store.coords['time']
+    if ( list(store.shape[1:]) == [int(nn) for nn in shape] and
+         store.attrs == json.loads(json.dumps(kwargs.get('attrs') or {})) and
+         [_jsonable(tt) for tt in times[0:len(told)]] == told ):
+      ntkeep = len(told)
+      if xdata is not None:
+        for it,dd in enumerate(store.meta['digests']):
+          if dd != _digest(xdata[it],store.dtype):
+            ntkeep = it
+            break
+        store.truncate(ntkeep)
+      return store,ntkeep
+  return create(path,shape,**kwargs),0
+
+
+def store_fname(FNAME):
+  """
+  Store path associated with an output grib file name
+  e.g. AWDIR/SPI3_MON_HIND.grb -> AWDIR/SPI3_MON_HIND.spic
+  """
+  return os.path.splitext(FNAME)[0]+'.spic'
@@ -0,0 +1,151 @@
+#
+# Grib encoding helpers: pack output fields in parallel workers and
+# append the encoded messages to the output file in the original order
+#
+
+from __future__ import print_function
+
+import itertools
+import time
+import multiprocessing
+
+import numpy as np
+import eccodes as ec
+
+from . import spi
+from . import instrument
+
+# Default packing options used for SPI output fields
+SPI_KEYS = [('bitsPerValue',12),
+            ('bitmapPresent',1),
+            ('missingValue',spi.ZMISS)]
+
+
+def get_message(gid):
+  """
+  Return the encoded bytes of a grib handle, to be used as a template
+  """
+  return ec.codes_get_message(gid)
+
+
+def encode_message(job):
+  """
+  Encode a single grib message
+  job: (msg,keys,values)
+   msg: encoded template message (bytes)
+   keys: list of (key,value) pairs, set in order before the values
+   values: np.array with the field values, nan are encoded as missing
+           (spi.ZMISS, with the bitmap of the template)
+  returns the encoded message (bytes)
+  """
+  msg,keys,values = job
+  gid = ec.codes_new_from_message(msg)
+  # missingValue is not part of the encoded template, set it again so
+  # that the nan are not encoded as values
+  ec.codes_set(gid,'missingValue',spi.ZMISS)
+  for key,val in keys:
+    ec.codes_set(gid,key,val)
+  xtmp = np.ma.filled(np.ma.fix_invalid(values),spi.ZMISS)
+  ec.codes_set_values(gid,xtmp)
+  out = ec.codes_get_message(gid)
+  ec.codes_release(gid)
+  return out
+
+
+def decode_values(msg):
+  """
+  Field values of an encoded message (bytes) as read back from the file
+  by core.load_grb_file: packed precision, nan for missing values
+  """
+  gid = ec.codes_new_from_message(msg)
+  xtmp = ec.codes_get_values(gid)
+  if ec.codes_get(gid,'bitmapPresent') == 1:
+    zmiss = ec.codes_get(gid,'missingValue')
+    xtmp[xtmp==zmiss] = np.nan
+  ec.codes_release(gid)
+  return xtmp
+
+
+def encode_decode_message(job):
+  """
+  encode_message, also returning the decoded values of the message
+  """
+  out = encode_message(job)
+  return out,decode_values(out)
+
+
+def write_messages(fout,jobs,nproc=1,chunksize=4,keep=None):
+  """
+  Encode and write grib messages to an open file
+  fout: file object opened for writing
+  jobs: iterable of (msg,keys,values), see encode_message
+  nproc: number of worker processes (<=1 encodes in the calling process)
+  chunksize: number of messages sent to each worker at once
+  keep: list to which the values decoded from each written message are
+        appended (e.g. for core.memstore), not done if None
+  The messages are written in the order of jobs, the output is identical
+  to encoding them serially. Returns the number of messages written.
+  Only the encoding and writing are timed (stage write_messages), not the
+  production of the jobs (e.g. by a generator).
+  """
+  nmsg = 0
+  nbytes = 0
+  dtime = 0.
+  worker = encode_message if keep is None else encode_decode_message
+  if nproc is None or nproc <= 1:
+    for job in jobs:
+      t0 = time.time()
+      out = worker(job)
+      if keep is not None:
+        out,xdec = out
+        keep.append(xdec)
+      fout.write(out)
+      dtime += time.time()-t0
+      nmsg = nmsg+1
+      nbytes = nbytes+len(out)
+    instrument.add_time('write_messages',dtime)
+    instrument.count_io(fout.name,'write',nmsg,nbytes)
+    return nmsg
+
+  # work in batches so that only a limited number of fields is in flight
+  nbatch = nproc*chunksize*4
+  jobs = iter(jobs)
+  pool = multiprocessing.Pool(nproc)
+  try:
+    while True:
+      batch = list(itertools.islice(jobs,nbatch))
+      if len(batch) == 0:
+        break
+      t0 = time.time()
+      for out in pool.imap(worker,batch,chunksize):
+        if keep is not None:
+          out,xdec = out
+          keep.append(xdec)
+        fout.write(out)
+        nmsg = nmsg+1
+        nbytes = nbytes+len(out)
+      dtime += time.time()-t0
+  finally:
+    pool.close()
+    pool.join()
+  instrument.add_time('write_messages',dtime)
+  instrument.count_io(fout.name,'write',nmsg,nbytes)
+  return nmsg
+
+
+def file_jobs(FTEMPLATE,xdata,keys=SPI_KEYS):
+  """
+  Generate encoding jobs using every message of FTEMPLATE as template
+  xdata: np.array (nflds,npoints), one row per message in FTEMPLATE
+  """
+  fin = open(FTEMPLATE,'rb')
+  ikfld = 0
+  while 1:
+    gid = ec.codes_grib_new_from_file(fin)
+    if gid is None:
+      break
+    msg = get_message(gid)
+    ec.codes_release(gid)
+    yield msg,keys,xdata[ikfld,:]
+    ikfld = ikfld+1
+  fin.close()
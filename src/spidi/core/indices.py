@@ -0,0 +1,238 @@
+#
+# Standardized drought index engine
+#
+# An index registers the monitoring variables it needs, how to combine
+# their accumulations into the samples to standardize, its distribution
+# fit and its CDF transform. compute_indices accumulates each variable
+# once for all the requested indices and runs the fit and transform per
+# calendar month on blocks of grid points (optionally in threads).
+#
+# Registered indices:
+#  spi  : precipitation, gamma fit (core.fspi_fit and core.fspi_eval, as
+#         calc_spi_for), used by calc_spi_mon for its gamma SPI
+#  spei : precipitation - potential evapotranspiration, generalized
+#         logistic fit: the 3 parameter log-logistic of Vicente-Serrano et
+#         al. (2010) in the parametrization of Hosking (1997), also defined
+#         for negative skewness. Fitted with the L-moments of the samples,
+#         from probability weighted moments with plotting positions
+#         (i-0.35)/n as Vicente-Serrano et al.
+#  sri  : runoff, gamma fit
+#
+
+from __future__ import print_function
+
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import scipy.special as sps
+
+from . import spi
+from . import rolling
+from . import instrument
+
+CHUNK_POINTS = 8192 # number of grid points fitted/transformed at once
+
+REGISTRY = {}
+
+
+class StdIndex(object):
+  """
+  Standardized index
+   name: index name (e.g. spi)
+   variables: names of the input variables (e.g. ['precip'])
+   combine: function of the accumulated variables (in the order of
+            variables) returning the samples np.array (nt,ngp)
+   fit: function(D (nt,ngp)) returning the parameters (npar,ngp)
+   transform: function(D (nt,ngp),params) returning the standardized values
+  """
+  def __init__(self,name,variables,combine,fit,transform):
+    self.name = name
+    self.variables = list(variables)
+    self.combine = combine
+    self.fit = fit
+    self.transform = transform
+
+
+def register(index):
+  """
+  Make index (StdIndex) available to compute_indices by its name
+  """
+  REGISTRY[index.name] = index
+  return index
+
+
+def get_index(name):
+  if name not in REGISTRY:
+    raise KeyError("Index not available: %s (available: %s)"%(name,sorted(REGISTRY)))
+  return REGISTRY[name]
+
+
+##===================================
+## Distribution fits and transforms
+
+def gamma_fit(D):
+  """
+  Gamma fit with frequency of zero, params (3,ngp): shape, scale, pzero
+  """
+  coef,q = spi.fspi_fit(D,spi.ZeroMax,-1)
+  return np.array([coef[0],coef[1],q])
+
+
+def gamma_transform(D,params):
+  return spi.fspi_eval(D,spi.ZeroMax,params[0:2],params[2])
+
+
+def genlogistic_fit(D,nmin=4):
+  """
+  Generalized logistic fit with L-moments, from the probability weighted
+  moments b_r = mean(F**r * x) of the sorted samples x with plotting
+  positions F=(i-0.35)/n
+  params (3,ngp): location (xi), scale (alpha) and shape (k), nan where
+  less than nmin valid samples or all the samples are equal.
+  k = -(L-skewness), k < 0 is the log-logistic with beta = -1/k
+  """
+  nt,ngp = D.shape
+  xs = np.sort(D,axis=0).astype(np.float64) # nan last
+  nv = np.sum(~np.isnan(D),axis=0).astype(np.float64)
+  ii = np.arange(1,nt+1)[:,None]
+  lvalid = ii <= nv[None,:]
+  with np.errstate(invalid='ignore',divide='ignore'):
+    F = np.where(lvalid,(ii-0.35)/nv[None,:],0.)
+    xw = np.where(lvalid,xs,0.)
+    b0 = np.sum(xw,axis=0)/nv
+    b1 = np.sum(F*xw,axis=0)/nv
+    b2 = np.sum(F**2*xw,axis=0)/nv
+    l1 = b0
+    l2 = 2.*b1-b0
+    k = -(6.*b2-6.*b1+b0)/l2
+    xmax = np.max(np.where(lvalid,xs,-np.inf),axis=0)
+    lbad = (nv < nmin) | ~(xmax > xs[0]) | ~(l2 > 0.) | ~(np.abs(k) < 1.)
+    k = np.where(lbad,0.,k)
+    lsmall = np.abs(k) < 1.e-6 # logistic limit
+    kpi = np.where(lsmall,1.,k*np.pi)
+    alpha = np.where(lsmall,l2,l2*np.sin(kpi)/kpi)
+    xi = np.where(lsmall,l1,l1-alpha*(1./np.where(lsmall,1.,k)-np.pi/np.sin(kpi)))
+  params = np.array([xi,alpha,k])
+  params[:,lbad] = np.nan
+  return params
+
+
+def genlogistic_transform(D,params):
+  xi,alpha,k = params
+  with np.errstate(invalid='ignore',divide='ignore',over='ignore'):
+    lsmall = np.abs(k) < 1.e-6
+    kk = np.where(lsmall,1.,k)
+    arg = 1.-kk*(D-xi)/alpha
+    ## outside the support: above the upper bound (k>0) or bellow the
+    ## lower bound (k<0)
+    yout = np.where(kk > 0.,np.inf,-np.inf)
+    y = np.where(arg > 0.,-np.log(np.where(arg > 0.,arg,1.))/kk,yout)
+    y = np.where(lsmall,(D-xi)/alpha,y)
+    prob = 1./(1.+np.exp(-y))
+  prob = np.where(np.isnan(D) | np.isnan(alpha),np.nan,prob)
+  prob = np.clip(prob,0.001,0.999)
+  return sps.ndtri(prob)
+
+
+register(StdIndex('spi',['precip'],lambda P: P,gamma_fit,gamma_transform))
+register(StdIndex('spei',['precip','pet'],lambda P,E: P-E,
+                  genlogistic_fit,genlogistic_transform))
+register(StdIndex('sri',['runoff'],lambda R: R,gamma_fit,gamma_transform))
+
+
+##===================================
+## Engine
+
+def required_variables(names):
+  """
+  Input variables needed by the indices names
+  """
+  variables = []
+  for name in names:
+    for vv in get_index(name).variables:
+      if vv not in variables:
+        variables.append(vv)
+  return variables
+
+
+def accumulate(names,data,tscale):
+  """
+  Accumulations over tscale months of the input variables of the indices
+  names, dictionary variable -> np.array (nt,ngp) (float32)
+  """
+  acc = {}
+  for vv in required_variables(names):
+    acc[vv] = rolling.rolling_sum(data[vv],tscale,axis=0,dtype=np.float32,
+                                  method='compensated')
+  return acc
+
+
+@instrument.timed('compute_indices')
+def compute_indices(names,data,tscale,months,lfit,nthreads=1,chunk=CHUNK_POINTS,
+                    acc=None,params=None):
+  """
+  Standardized indices from monthly data, sharing the accumulation
+  results = compute_indices(names,data,tscale,months,lfit,nthreads,chunk,acc,params)
+  input:
+   names: list of registered index names
+   data: dictionary variable -> np.array (nt,ngp) monthly values
+   tscale: accumulation time scale (months)
+   months: np.array (nt) calendar month of each row
+   lfit: np.array (nt) bool, rows used in the fit (e.g. hindcast period)
+   nthreads: number of threads working on blocks of grid points
+   chunk: number of grid points per block
+   acc: accumulations already done (see accumulate), data is not used
+   params: dictionary name -> np.array (12,npar,ngp) parameters of a
+           previous fit (e.g. from a parameters cache), these indices are
+           only transformed
+  returns dictionary name -> (xind,params)
+   xind: np.array (nt,ngp) standardized index, nan in the first tscale-1 rows
+   params: np.array (12,npar,ngp) fitted parameters per calendar month
+  """
+  ## accumulate each variable once
+  if acc is None:
+    acc = accumulate(names,data,tscale)
+  if params is None:
+    params = {}
+  nt,ngp = acc[required_variables(names)[0]].shape
+  lok = np.arange(nt) >= tscale-1 # complete accumulations
+  months = np.asarray(months)
+
+  results = {}
+  pool = ThreadPool(nthreads) if nthreads > 1 else None
+  try:
+    for name in names:
+      index = get_index(name)
+      D = index.combine(*[acc[vv] for vv in index.variables])
+      xind = np.zeros((nt,ngp),dtype=np.float32)*np.nan
+      plist = [None]*12
+      pprev = params.get(name)
+
+      def work(job):
+        im,ip0,ip1 = job
+        ttout = np.nonzero((months == im+1) & lok)[0]
+        if pprev is None:
+          ttfit = np.nonzero((months == im+1) & lfit & lok)[0]
+          ## transform with the parameters as stored (single precision)
+          pars = index.fit(D[ttfit,ip0:ip1]).astype(np.float32)
+        else:
+          pars = pprev[im][:,ip0:ip1]
+        xind[ttout,ip0:ip1] = index.transform(D[ttout,ip0:ip1],pars)
+        return im,ip0,ip1,pars
+
+      jobs = [(im,ip0,min(ip0+chunk,ngp)) for im in range(12) for ip0 in range(0,ngp,chunk)]
+      if pool is None:
+        done = map(work,jobs)
+      else:
+        done = pool.imap_unordered(work,jobs)
+      for im,ip0,ip1,pars in done:
+        if plist[im] is None:
+          plist[im] = np.zeros((pars.shape[0],ngp),dtype=np.float32)*np.nan
+        plist[im][:,ip0:ip1] = pars
+      print('Computed index,tscale:',name,tscale)
+      results[name] = (xind,np.array(plist))
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+  return results
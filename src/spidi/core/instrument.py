@@ -0,0 +1,200 @@
+#
+# Run instrumentation: stage timers, peak memory (RSS) sampling and
+# fields/bytes decoded and encoded per file, written as a JSON report
+#
+# Instrumentation is disabled unless start() is called, e.g. with the
+# --PROFILE=report.json option of the spidi scripts.
+#
+
+from __future__ import print_function
+
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+_RUN = None
+
+
+class Run(object):
+  """
+  Instrumentation state of one entry point run
+  """
+  def __init__(self,fname,entry,interval=0.5,persistent=False):
+    self.fname = fname
+    self.entry = entry
+    self.persistent = persistent
+    self.t0 = time.time()
+    self.stages = {}
+    self.files = {}
+    self.active = []
+    self.peak_rss = rss_mb()
+    self.lock = threading.Lock()
+    self.running = True
+    self.sampler = threading.Thread(target=self._sample,args=(interval,))
+    self.sampler.daemon = True
+    self.sampler.start()
+
+  def _sample(self,interval):
+    while self.running:
+      self.update_rss()
+      time.sleep(interval)
+
+  def update_rss(self):
+    xrss = rss_mb()
+    with self.lock:
+      self.peak_rss = max(self.peak_rss,xrss)
+      for st in self.active:
+        st['peak_rss_mb'] = max(st['peak_rss_mb'],xrss)
+
+  def report(self):
+    return {'entry':self.entry,
+            'argv':sys.argv,
+            'start':time.strftime('%Y-%m-%dT%H:%M:%S',time.localtime(self.t0)),
+            'wall_time':time.time()-self.t0,
+            'peak_rss_mb':max(self.peak_rss,maxrss_mb()),
+            'stages':self.stages,
+            'files':self.files}
+
+
+def rss_mb():
+  """
+  Current resident memory of the process in MB (peak if not available)
+  """
+  try:
+    fin = open('/proc/self/statm')
+    npages = int(fin.read().split()[1])
+    fin.close()
+    return npages*os.sysconf('SC_PAGE_SIZE')/1024.**2
+  except (IOError,OSError,ValueError):
+    return maxrss_mb()
+
+
+def maxrss_mb():
+  """
+  Peak resident memory of the process in MB
+  """
+  xrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    return xrss/1024.**2
+  return xrss/1024.
+
+
+def start(fname,entry,persistent=False):
+  """
+  Enable instrumentation, the report is written to fname by finish()
+  fname: output json file, nothing is done if None
+  entry: name of the entry point (e.g. spidi-spi-mon)
+  persistent: if True, the run covers several entry points called in the
+              same process (spidi.pipeline): their start() and finish()
+              calls are ignored until finish(force=True)
+  """
+  global _RUN
+  if fname is None or (_RUN is not None and _RUN.persistent):
+    return
+  _RUN = Run(fname,entry,persistent=persistent)
+
+
+def finish(force=False):
+  """
+  Write the JSON run report and disable instrumentation
+  """
+  global _RUN
+  if _RUN is None or (_RUN.persistent and not force):
+    return
+  run = _RUN
+  _RUN = None
+  run.running = False
+  run.update_rss()
+  fout = open(run.fname,'w')
+  json.dump(run.report(),fout,indent=1,sort_keys=True)
+  fout.close()
+  print("Run report written to:",run.fname)
+
+
+def detach():
+  """
+  Disable instrumentation without writing the report, e.g. in a process
+  forked from an instrumented one (the report is written by the parent)
+  """
+  global _RUN
+  _RUN = None
+
+
+def enabled():
+  return _RUN is not None
+
+
+@contextmanager
+def stage(name):
+  """
+  Context manager timing a stage (stages can be nested)
+  e.g. with instrument.stage('fspi_fit'): ...
+  """
+  run = _RUN
+  if run is None:
+    yield
+    return
+  with run.lock:
+    st = run.stages.setdefault(name,{'calls':0,'time':0.,'peak_rss_mb':0.})
+    st['calls'] += 1
+    run.active.append(st)
+  t0 = time.time()
+  try:
+    yield
+  finally:
+    run.update_rss()
+    with run.lock:
+      st['time'] += time.time()-t0
+      run.active.remove(st)
+
+
+def timed(name):
+  """
+  Decorator timing each call of a function as stage name
+  """
+  def decorator(func):
+    @wraps(func)
+    def wrapper(*args,**kwargs):
+      if _RUN is None:
+        return func(*args,**kwargs)
+      with stage(name):
+        return func(*args,**kwargs)
+    return wrapper
+  return decorator
+
+
+def add_time(name,dtime,calls=1):
+  """
+  Add dtime seconds to stage name, for work interleaved with other work
+  (e.g. encoding the messages produced by a generator) that cannot be
+  timed as a single block
+  """
+  run = _RUN
+  if run is None:
+    return
+  with run.lock:
+    st = run.stages.setdefault(name,{'calls':0,'time':0.,'peak_rss_mb':0.})
+    st['calls'] += calls
+    st['time'] += dtime
+
+
+def count_io(fname,mode,nfields,nbytes=None):
+  """
+  Count fields and bytes decoded (mode='read') or encoded (mode='write')
+  for file fname. nbytes defaults to the file size.
+  """
+  run = _RUN
+  if run is None:
+    return
+  if nbytes is None:
+    nbytes = os.path.getsize(fname) if os.path.exists(fname) else 0
+  with run.lock:
+    xf = run.files.setdefault(str(fname),{'read_fields':0,'read_bytes':0,
+                                          'write_fields':0,'write_bytes':0})
+    xf[mode+'_fields'] += int(nfields)
+    xf[mode+'_bytes'] += int(nbytes)
@@ -0,0 +1,128 @@
+#
+# In-memory store of decoded grib files shared by the stages of a pipeline
+# run (spidi.pipeline), so that a file written or read by one stage is not
+# decoded again by the next ones.
+#
+# The store is disabled unless enable() is called. Entries are keyed by
+# file name and requested keys (as core.load_grb_file) and are dropped
+# when the file on disk changes. Arrays are copied on the way out since
+# the callers modify them in place.
+#
+
+from __future__ import print_function
+
+import os
+import threading
+
+import numpy as np
+
+MEMSTORE_MAXMB = 8192. # default maximum size of the store (MB)
+
+_STORE = None
+_LOCK = threading.Lock()
+
+
+class Store(object):
+  """
+  Decoded fields limited to maxmb MB, least recently used entries are
+  removed first
+  """
+  def __init__(self,maxmb=MEMSTORE_MAXMB):
+    self.maxmb = float(maxmb)
+    self.entries = {}
+    self.tick = 0
+
+  def nbytes(self):
+    return sum([ee['nbytes'] for ee in self.entries.values()])
+
+  def evict(self):
+    while self.entries and self.nbytes() > self.maxmb*1024**2:
+      key = min(self.entries,key=lambda kk: self.entries[kk]['tick'])
+      del self.entries[key]
+
+
+def _key(fname,retKeys):
+  return (os.path.abspath(fname),tuple(retKeys or ()))
+
+
+def _fstat(fname):
+  if not os.path.exists(fname):
+    return None
+  fstat = os.stat(fname)
+  return (fstat.st_size,fstat.st_mtime)
+
+
+def _copy(xdata,xKeys):
+  if xKeys is None:
+    return xdata.copy()
+  return xdata.copy(),dict((kk,np.array(vv)) for kk,vv in xKeys.items())
+
+
+def enable(maxmb=None):
+  """
+  Enable the store (maximum size maxmb MB)
+  """
+  global _STORE
+  with _LOCK:
+    _STORE = Store(MEMSTORE_MAXMB if maxmb is None else maxmb)
+
+
+def disable():
+  """
+  Disable the store and release its content
+  """
+  global _STORE
+  with _LOCK:
+    _STORE = None
+
+
+def enabled():
+  return _STORE is not None
+
+
+def put(fname,retKeys,xdata,xKeys=None):
+  """
+  Store the decoded content of fname, to be called once the file is
+  written and closed
+   retKeys: list of keys in xKeys (as core.load_grb_file)
+   xdata: np.array (nflds,npoints), nan for missing values, as decoded from
+          the written messages (see core.grbio.decode_values) so that the
+          readers get the same values as from the file
+   xKeys: dictionary with an array per key in retKeys
+  """
+  store = _STORE
+  if store is None:
+    return
+  xdata = np.asarray(xdata,dtype=np.float32)
+  if retKeys is None:
+    xKeys = None
+  with _LOCK:
+    store.tick += 1
+    store.entries[_key(fname,retKeys)] = {'fstat':_fstat(fname),
+                                          'data':_copy(xdata,xKeys),
+                                          'nbytes':xdata.nbytes,
+                                          'tick':store.tick}
+    store.evict()
+
+
+def get(fname,retKeys=None):
+  """
+  Return the content of fname stored with retKeys (xdata or (xdata,xKeys)
+  as core.load_grb_file), None if not in the store or if the file changed
+  """
+  store = _STORE
+  if store is None:
+    return None
+  key = _key(fname,retKeys)
+  with _LOCK:
+    entry = store.entries.get(key)
+    if entry is None:
+      return None
+    if entry['fstat'] != _fstat(fname):
+      del store.entries[key]
+      return None
+    store.tick += 1
+    entry['tick'] = store.tick
+  if retKeys is None:
+    return entry['data'].copy()
+  return _copy(*entry['data'])
@@ -0,0 +1,128 @@
+#
+# Monitoring cache: decoded monitoring precipitation stored as a numpy
+# archive next to the grib file, to skip grib decoding when loading it
+#
+# The cache holds the values decoded from the grib messages (packed
+# precision) and the size, modification time and sha256 of the grib file
+# it was made from: it is only used while the grib file has that content,
+# and then gives the same values as decoding the grib file. When the grib
+# file does not exist the cache is used on its own, with a warning.
+#
+
+from __future__ import print_function
+
+import os
+
+import numpy as np
+
+from . import spi
+from . import memstore
+from . import pcache
+
+
+def cache_fname(FNAME):
+  """
+  Cache file name associated with a monitoring grib file
+  e.g. AWDIR/MON_HIND.grb -> AWDIR/MON_HIND.npz
+  """
+  return os.path.splitext(FNAME)[0]+'.npz'
+
+
+def save_mon_cache(FCACHE,xdata,years,months,FSOURCE=None):
+  """
+  Save monitoring data to the cache
+   FCACHE: cache file name
+   xdata: np.array (nt,npoints), nan for missing values, as decoded from
+          the fields of FSOURCE
+   years,months: np.array (nt) with the year and month of each field
+   FSOURCE: grib file with the same content (if any), its size, modification
+            time and sha256 are stored so that the cache is only used while
+            that file is unchanged
+  """
+  source_size = -1
+  source_mtime = -1.
+  source_sha256 = ''
+  if FSOURCE is not None and os.path.exists(FSOURCE):
+    fstat = os.stat(FSOURCE)
+    source_size = fstat.st_size
+    source_mtime = fstat.st_mtime
+    source_sha256 = pcache.fingerprint(FSOURCE)
+  fout = open(FCACHE,'wb')
+  np.savez(fout,xdata=xdata.astype(np.float32),
+           year=np.asarray(years),month=np.asarray(months),
+           source_size=source_size,source_mtime=source_mtime,
+           source_sha256=source_sha256)
+  fout.close()
+  print("File created:",FCACHE)
+
+
+def load_mon_cache(FCACHE):
+  """
+  Load monitoring data from the cache
+  returns xdata,xKeys as core.load_grb_file with retKeys=['year','month']
+  """
+  zz = np.load(FCACHE)
+  xdata = zz['xdata']
+  xKeys = {'year':zz['year'],'month':zz['month']}
+  zz.close()
+  return xdata,xKeys
+
+
+def valid_cache(FNAME,FCACHE=None):
+  """
+  Check if the cache of FNAME exists and was made from the current content
+  of FNAME: same size and modification time, or when the modification time
+  differs (e.g. a copy of the file) same sha256.
+  False if FNAME does not exist.
+  """
+  if FCACHE is None:
+    FCACHE = cache_fname(FNAME)
+  if not os.path.exists(FCACHE) or not os.path.exists(FNAME):
+    return False
+  zz = np.load(FCACHE)
+  if 'source_sha256' not in zz.files: # written by an older version
+    zz.close()
+    return False
+  source_size = int(zz['source_size'])
+  source_mtime = float(zz['source_mtime']) if 'source_mtime' in zz.files else None
+  source_sha256 = str(zz['source_sha256'])
+  zz.close()
+  fstat = os.stat(FNAME)
+  if source_size != fstat.st_size:
+    return False
+  if source_mtime == fstat.st_mtime:
+    return True
+  return source_sha256 == pcache.fingerprint(FNAME)
+
+
+def source_fname(FNAME):
+  """
+  File holding the monitoring data loaded by load_mon_hind(FNAME): the grib
+  file, or the cache when there is no grib file
+  """
+  if os.path.exists(FNAME):
+    return FNAME
+  return cache_fname(FNAME)
+
+
+def load_mon_hind(FNAME,verbose=False):
+  """
+  Load monitoring data from the cache when up to date, from grib otherwise
+  (from the cache when there is no grib file)
+  xdata,xKeys=load_mon_hind(FNAME,verbose=False)
+  """
+  xx = memstore.get(FNAME,['year','month'])
+  if xx is not None:
+    if verbose:
+      print('Reading (memory):',FNAME)
+    return xx
+  FCACHE = cache_fname(FNAME)
+  if valid_cache(FNAME,FCACHE):
+    if verbose:
+      print('Reading cache:',FCACHE)
+    return load_mon_cache(FCACHE)
+  if not os.path.exists(FNAME) and os.path.exists(FCACHE):
+    print('Warning: %s not found, reading the cache %s that cannot be '
+          'checked against it'%(FNAME,FCACHE))
+    return load_mon_cache(FCACHE)
+  return spi.load_grb_file(FNAME,retKeys=['year','month'],verbose=verbose)
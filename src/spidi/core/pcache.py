@@ -0,0 +1,132 @@
+#
+# Content-addressed cache of fitted parameters
+#
+# Entries are keyed by a hash of the content of the input files, the fit
+# options, the spidi version and PCACHE_VERSION, so that an identical fit
+# (same hindcast and monitoring data) is read back instead of being
+# recomputed. PCACHE_VERSION must be increased with any change of the
+# fitted parameters or of the content of the entries, the entries of
+# other versions are then not used (and evicted as the least recent).
+# The cache lives in a local directory with a size limit, the least
+# recently used entries are removed first.
+#
+
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from . import instrument
+
+PCACHE_MAXMB = 4096. # default maximum size of the cache directory (MB)
+PCACHE_VERSION = 2 # version of the fit algorithms and entries (see above)
+
+_FINGERPRINTS = {}
+
+
+def fingerprint(fname,blocksize=2**20):
+  """
+  sha256 of the content of fname (computed once per process for a given
+  file size and modification time)
+  """
+  fstat = os.stat(fname)
+  mkey = (os.path.abspath(fname),fstat.st_size,fstat.st_mtime)
+  if mkey not in _FINGERPRINTS:
+    hh = hashlib.sha256()
+    fin = open(fname,'rb')
+    while True:
+      buf = fin.read(blocksize)
+      if not buf:
+        break
+      hh.update(buf)
+    fin.close()
+    _FINGERPRINTS[mkey] = hh.hexdigest()
+  return _FINGERPRINTS[mkey]
+
+
+def cache_key(files,options):
+  """
+  Key of a cache entry
+   files: list of input file names (the order matters)
+   options: dictionary with the fit options (json serializable values)
+  """
+  from spidi import __version__
+  desc = {'files':[fingerprint(ff) for ff in files],
+          'options':options,
+          'version':__version__,
+          'pcache_version':PCACHE_VERSION}
+  return hashlib.sha256(json.dumps(desc,sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ParamCache(object):
+  """
+  Parameter cache in directory cdir limited to maxmb MB
+  """
+  def __init__(self,cdir,maxmb=PCACHE_MAXMB):
+    self.cdir = cdir
+    self.maxmb = float(maxmb)
+    if not os.path.isdir(cdir):
+      os.makedirs(cdir)
+
+  def fname(self,key):
+    return os.path.join(self.cdir,key+'.npz')
+
+  def get(self,key):
+    """
+    Return the dictionary of arrays stored under key, None if not present
+    """
+    fname = self.fname(key)
+    if not os.path.exists(fname):
+      return None
+    with instrument.stage('pcache_get'):
+      zz = np.load(fname)
+      data = dict((kk,zz[kk]) for kk in zz.files)
+      zz.close()
+    os.utime(fname,None) # mark as recently used
+    print('Parameter cache hit:',fname)
+    return data
+
+  def put(self,key,**arrays):
+    """
+    Store the arrays under key and apply the size limit
+    """
+    with instrument.stage('pcache_put'):
+      fd,ftmp = tempfile.mkstemp(dir=self.cdir,suffix='.tmp')
+      fout = os.fdopen(fd,'wb')
+      np.savez(fout,**arrays)
+      fout.close()
+      os.rename(ftmp,self.fname(key))
+    print('Parameter cache entry created:',self.fname(key))
+    self.evict()
+
+  def evict(self):
+    """
+    Remove the least recently used entries above the size limit
+    """
+    entries = []
+    for ff in os.listdir(self.cdir):
+      if ff.endswith('.npz'):
+        fstat = os.stat(os.path.join(self.cdir,ff))
+        entries.append((fstat.st_mtime,fstat.st_size,ff))
+    entries.sort()
+    total = sum([ee[1] for ee in entries])
+    while entries and total > self.maxmb*1024**2:
+      xtime,xsize,ff = entries.pop(0)
+      os.remove(os.path.join(self.cdir,ff))
+      total = total-xsize
+      print('Parameter cache entry removed:',ff)
+
+
+def open_cache(cdir,maxmb=None):
+  """
+  ParamCache in cdir, None if cdir is None (cache disabled)
+  """
+  if cdir is None:
+    return None
+  if maxmb is None:
+    maxmb = PCACHE_MAXMB
+  return ParamCache(cdir,maxmb)
@@ -0,0 +1,189 @@
+#
+# Rolling window accumulation of precipitation
+#
+# rolling_sum(a,n,...) : sum over the last n values along one axis
+# rolling_sums(a,ns,...) : several window lengths from a single pass
+#
+# Methods:
+#  'cumsum'      : difference of cumulative sums (fastest, loses precision
+#                  on long records in float32)
+#  'compensated' : running window sum with Neumaier compensation
+#  'direct'      : explicit sum of the n shifted slices, O(n) passes
+#
+
+from __future__ import print_function
+
+import sys
+import time
+
+import numpy as np
+
+METHODS = ('cumsum','compensated','direct')
+
+
+def _prepare(a,axis,dtype):
+  """
+  Move the accumulation axis to the front, replace nan by zero and
+  compute the cumulative count of valid values (None if all are valid)
+  """
+  x = np.moveaxis(np.asarray(a),axis,0)
+  invalid = np.isnan(x)
+  if not invalid.any():
+    return x.astype(dtype,copy=False),None
+  x = np.where(invalid,0,x).astype(dtype,copy=False)
+  return x,np.cumsum(~invalid,axis=0,dtype=np.int32)
+
+
+def _sum_cumsum(x,n,ret,cs):
+  ret[...] = cs
+  ret[n:] = cs[n:]-cs[:-n]
+
+
+def _sum_compensated(x,n,ret):
+  s = np.zeros(x.shape[1:],dtype=ret.dtype)
+  c = np.zeros(x.shape[1:],dtype=ret.dtype)
+
+  def add(s,c,xv):
+    # Neumaier summation step
+    t = s+xv
+    c += np.where(np.abs(s) >= np.abs(xv),(s-t)+xv,(xv-t)+s)
+    return t
+
+  for it in range(x.shape[0]):
+    s = add(s,c,x[it])
+    if it >= n:
+      s = add(s,c,-x[it-n])
+    ret[it] = s+c
+
+
+def _sum_direct(x,n,ret):
+  nt = x.shape[0]
+  ret[...] = 0.
+  for k in range(min(n,nt)):
+    ret[k:] += x[:nt-k]
+
+
+def _window(x,vcs,n,method,min_count,partial,ret,cs=None):
+  """
+  Rolling sum of x (accumulation axis first) over windows of length n,
+  written into ret
+  """
+  if method == 'cumsum':
+    if cs is None:
+      cs = np.cumsum(x,axis=0,dtype=ret.dtype)
+    _sum_cumsum(x,n,ret,cs)
+  elif method == 'compensated':
+    _sum_compensated(x,n,ret)
+  else:
+    _sum_direct(x,n,ret)
+  if not partial:
+    ret[0:n-1] = np.nan
+  if vcs is None:
+    return
+  if min_count is None:
+    min_count = n
+  cnt = vcs.copy()
+  cnt[n:] = vcs[n:]-vcs[:-n]
+  if partial:
+    nt = x.shape[0]
+    ret[cnt < np.minimum(min_count,np.arange(1,nt+1)).reshape((-1,)+(1,)*(x.ndim-1))] = np.nan
+  else:
+    ret[cnt < min_count] = np.nan
+
+
+def rolling_sum(a,n,axis=0,dtype=np.float64,method='cumsum',min_count=None,
+                partial=False,out=None):
+  """
+  Rolling sum over windows of length n along axis
+   a: np.array, nan are treated as missing
+   n: window length
+   axis: accumulation axis (any)
+   dtype: output/accumulation data type (e.g. np.float32 or np.float64)
+   method: 'cumsum','compensated' or 'direct' (see module header)
+   min_count: minimum number of valid values in a window (default n),
+              windows with fewer valid values are set to nan
+   partial: if True the first n-1 values hold the sum of the available
+            (shorter) windows, otherwise they are nan
+   out: optional output array with the shape of a and type dtype, the
+        result is computed in place
+  returns an array with the shape of a, each value is the sum of the
+  window ending at that position
+  """
+  if method not in METHODS:
+    raise ValueError('rolling_sum: unknown method %s'%method)
+  x,vcs = _prepare(a,axis,dtype)
+  if out is None:
+    out = np.empty(np.shape(a),dtype=dtype)
+  _window(x,vcs,n,method,min_count,partial,np.moveaxis(out,axis,0))
+  return out
+
+
+def rolling_sums(a,ns,axis=0,dtype=np.float64,method='cumsum',min_count=None,
+                 partial=False,index=None):
+  """
+  Rolling sums for several window lengths, sharing the preparation and
+  (for method='cumsum') the cumulative sum
+   ns: list of window lengths (0 gives zeros), other arguments as rolling_sum
+   (min_count, if given, is applied to all windows)
+   index: positions along axis to return (default all), the windows are
+          computed in one buffer and only these positions are kept
+  returns a dictionary {n: np.array}
+  """
+  if method not in METHODS:
+    raise ValueError('rolling_sum: unknown method %s'%method)
+  x,vcs = _prepare(a,axis,dtype)
+  cs = None
+  if method == 'cumsum':
+    cs = np.cumsum(x,axis=0,dtype=dtype)
+  rets = {}
+  buf = np.zeros(np.shape(a),dtype=dtype)
+  for n in ns:
+    buf[...] = 0.
+    if n > 0:
+      _window(x,vcs,n,method,min_count,partial,np.moveaxis(buf,axis,0),cs)
+    if index is None:
+      rets[n] = buf.copy()
+    else:
+      rets[n] = np.take(buf,index,axis=axis)
+  return rets
+
+
+def benchmark(nyear=60,ngp=64800,n=12,seed=0):
+  """
+  Compare the rolling sum methods with a plain float64 cumulative sum
+  on a synthetic record of nyear years of monthly values on ngp points.
+  Timings and the maximum error against a float64 direct sum are printed.
+  """
+  rng = np.random.RandomState(seed)
+  a = rng.gamma(0.8,3.,size=(nyear*12,ngp)).astype(np.float32)
+  ref = rolling_sum(a,n,method='direct',dtype=np.float64)
+
+  def report(label,func):
+    t0 = time.time()
+    ret = func()
+    dtime = time.time()-t0
+    err = np.nanmax(np.abs(ret.astype(np.float64)-ref))
+    print('%-30s %8.3f s  max abs error: %.3e'%(label,dtime,err))
+
+  def cumsum_ref():
+    ret = np.cumsum(a,axis=0,dtype=float)
+    ret[n:] = ret[n:]-ret[:-n]
+    ret[0:n-1] = np.nan
+    return ret
+
+  report('np.cumsum (float64)',cumsum_ref)
+  for method in METHODS:
+    for dtype in (np.float32,np.float64):
+      report('%s %s'%(method,np.dtype(dtype).name),
+             lambda: rolling_sum(a,n,dtype=dtype,method=method))
+  out = np.zeros(a.shape,dtype=np.float32)
+  report('compensated float32 out=',
+         lambda: rolling_sum(a,n,dtype=np.float32,method='compensated',out=out))
+  report('rolling_sums 1,3,6,12,24 cumsum',
+         lambda: rolling_sums(a,[1,3,6,12,24],dtype=np.float64)[n])
+
+
+if __name__ == "__main__":
+  # python -m spidi.core.rolling [nyear] [ngp]
+  args = [int(aa) for aa in sys.argv[1:3]]
+  benchmark(*args)
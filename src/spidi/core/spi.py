@@ -12,11 +12,21 @@ import scipy.stats as ss
 import scipy.special as sps
 import eccodes as ec
 
+from . import instrument
+from . import memstore
+from . import rolling
+
 ## Generic variables 
 PminDAY = 0.03  # minimum precipitation thrshold mm/day == 0.9 mm/month
 ZeroMax = 1./3. # maximum frequency of zero to be accepted in the gamma fit 
 MONHTAG="MON_HIND"
 ZMISS=-99 # default missing value for grib encoding 
+GRINGORTEN=0.44 # plotting position constant of the empirical SPI 
+SPI_DROUGHT=[-1.,-1.5,-2.] # thresholds of the ensemble drought probabilities
+SPI_PERCENTILES=[10.,50.,90.] # percentiles of the ensemble summary
+BOOT_N=200 # number of bootstrap replicates
+BOOT_PERC=[5.,50.,95.] # percentiles of the bootstrap distributions
+BOOT_MAXSIZE=2**24 # maximum size of the (nboot,ne,points) bootstrap arrays
 
 
 def load_hindY(fname,kidia=None,kfdia=None):
@@ -74,36 +84,24 @@ def get_opt(OPTL=[''],OPTSS=['']):
       OPT[key] = OPTS[key]
   return OPT
   
+@instrument.timed('fspi_eval')
 def fspi_eval(D,zeromax,coef,q):
-  #xspi = spi.fspi_eval(xprecTMP,coef,q)
-  nt,ngp = D.shape
-  xspi = np.zeros((nt,ngp))*np.nan
-
-
-  for ip in xrange(ngp):
-    if q[ip] > zeromax or np.isnan(coef[1,ip]) :
-      continue
-    xspi[:,ip] = q[ip]+(1.-q[ip])*ss.gamma.cdf(D[:,ip],coef[0,ip],scale=coef[1,ip])
-  xspi[xspi < 0.001 ] = 0.001
-  xspi[xspi > 0.999 ] = 0.999
-  xspi[:,:] = ss.norm.ppf(xspi)
-
+  """
+  SPI of D (nt,ngp) from the gamma fit parameters coef (2,ngp) and the
+  frequency of zero q (ngp), nan where q > zeromax or the fit failed.
+  Same computation as gamma_spi (used by core.indices), in double precision
+  for D and coef
+  """
+  xspi = gamma_spi(np.asarray(D,dtype=np.float64),np.asarray(coef,dtype=np.float64),
+                   np.asarray(q),zeromax)
   xspi[np.isnan(D)]=np.nan
   return xspi
 
+@instrument.timed('fspi_fit')
 def fspi_fit(D,zeromax,dbg=-1):
 
   nt,ngp = D.shape
-  coef = np.zeros((2,ngp))*np.nan
-  q = np.zeros((ngp))*np.nan
-
-  q = (nt - np.sum(D>0.,axis=0)) / float(nt)
-  pp = np.nonzero(q<=zeromax)
-  coef[0,pp[0]],coef[1,pp[0]] = fitgamma(D[:,pp[0]])
-  pp = np.nonzero(coef[0,:] > 1000 )
-  #print("Error in spi.fspi_fit:",len(pp[0]),ngp)
-  coef[0,pp[0]] = np.nan
-  coef[1,pp[0]] = np.nan
+  coef,q = gamma_from_stats(gamma_stats(D),zeromax)
 
   if dbg >= 0:
     import matplotlib.pyplot as plt
@@ -115,6 +113,241 @@ def fspi_fit(D,zeromax,dbg=-1):
 
   return coef,q
 
+@instrument.timed('fspi_fit_loyo')
+def fspi_fit_loyo(D,groups,zeromax):
+  """
+  Cross-validated (leave-one-group-out) gamma fit
+  The sufficient statistics of the full sample are computed once, the
+  contribution of each group (e.g. hindcast year) is subtracted and the
+  maximum likelihood solve is done for all groups at once.
+  coef,q,glabels = fspi_fit_loyo(D,groups,zeromax)
+  input:
+   D: np.array (nt,ngp)
+   groups: np.array (nt) with the group (e.g. year) of each sample
+   zeromax: maximum frequency of zero to be accepted in the gamma fit
+  returns
+   coef: np.array (ngroup,2,ngp) shape and scale fitted without each group
+   q: np.array (ngroup,ngp) frequency of zero without each group
+   glabels: np.array (ngroup) sorted unique groups
+  """
+  groups = np.asarray(groups)
+  glabels = np.unique(groups)
+  gstats = np.array([gamma_stats(D[groups == gg,:]) for gg in glabels])
+  coef,q = gamma_loyo_from_stats(gstats,zeromax)
+  return coef,q,glabels
+
+def gamma_loyo_from_stats(gstats,zeromax):
+  """
+  Leave-one-group-out gamma fits from per group sufficient statistics
+  gstats: np.array (ngroup,4,...) (see gamma_stats)
+  returns coef (ngroup,2,...) and q (ngroup,...)
+  """
+  cvstats = np.sum(gstats,axis=0)[None,...] - gstats
+  coef,q = gamma_from_stats(np.moveaxis(cvstats,1,0),zeromax)
+  return np.moveaxis(coef,0,1),q
+
+@instrument.timed('fspi_boot')
+def fspi_boot(D,zeromax,nboot=BOOT_N,percentiles=BOOT_PERC,Deval=None,seed=None,
+              chunk=None):
+  """
+  Bootstrap of the gamma fit: the samples are resampled with replacement
+  nboot times, as multinomial weights (nboot,nt) applied to the sufficient
+  statistics with a matrix product, and all replicates are solved at once
+  coefp,qp,spip = fspi_boot(D,zeromax,nboot,percentiles,Deval,seed,chunk)
+  input:
+   D: np.array (nt,ngp) samples of the fit
+   zeromax: maximum frequency of zero to be accepted in the gamma fit
+   percentiles: list of percentiles (0-100) of the bootstrap distributions
+   Deval: np.array (ne,ngp), also return the percentiles of its SPI
+   seed: random seed of the resampling
+   chunk: number of grid points processed at once (limits the memory use),
+          by default BOOT_MAXSIZE/(nboot*ne)
+  returns
+   coefp: np.array (npercentiles,2,ngp) percentiles of shape and scale
+   qp: np.array (npercentiles,ngp) percentiles of the frequency of zero
+   spip: np.array (npercentiles,ne,ngp) percentiles of the SPI of Deval
+         (None if Deval is None)
+   nan where less than half of the replicates have a valid fit
+  """
+  import warnings
+  nt,ngp = D.shape
+  rng = np.random.RandomState(seed)
+  W = rng.multinomial(nt,np.ones(nt)/nt,size=nboot).astype(np.float64)
+  coefp = np.zeros((len(percentiles),2,ngp))*np.nan
+  qp = np.zeros((len(percentiles),ngp))*np.nan
+  spip = None
+  ne = 1
+  if Deval is not None:
+    ne = Deval.shape[0]
+    spip = np.zeros((len(percentiles),ne,ngp),dtype=np.float32)*np.nan
+  if chunk is None:
+    chunk = max(1,BOOT_MAXSIZE//(nboot*max(ne,1)))
+  for ip0 in range(0,ngp,chunk):
+    ip1 = min(ip0+chunk,ngp)
+    coef,q = gamma_from_stats(gamma_stats_weighted(D[:,ip0:ip1],W),zeromax)
+    lbad = np.sum(np.isnan(coef[1]),axis=0) > nboot//2
+    coefp[:,:,ip0:ip1] = nan_percentiles(np.swapaxes(coef,0,1),percentiles)
+    qp[:,ip0:ip1] = nan_percentiles(q,percentiles)
+    if Deval is not None:
+      with warnings.catch_warnings():
+        warnings.simplefilter('ignore',RuntimeWarning) # failed fits
+        xspi = gamma_spi(Deval[None,:,ip0:ip1],coef[:,:,None,:],q[:,None,:],zeromax)
+      spip[:,:,ip0:ip1] = nan_percentiles(xspi,percentiles)
+      del xspi
+    coefp[:,:,ip0:ip1][:,:,lbad] = np.nan
+    if Deval is not None:
+      spip[:,:,ip0:ip1][:,:,lbad] = np.nan
+  return coefp,qp,spip
+
+def gamma_spi(D,coef,q,zeromax):
+  """
+  SPI from the gamma fit parameters as fspi_eval, with broadcasting
+  (e.g. D (1,nt,ngp), coef (2,nboot,1,ngp), q (nboot,1,ngp))
+  """
+  with np.errstate(invalid='ignore',divide='ignore'):
+    prob = q+(1.-q)*sps.gammainc(coef[0],np.maximum(D/coef[1],0.))
+  prob = np.where((q > zeromax) | np.isnan(coef[1]),np.nan,prob)
+  prob = np.clip(prob,0.001,0.999)
+  return sps.ndtri(prob)
+
+def gamma_stats_weighted(D,W):
+  """
+  Sufficient statistics of the gamma fit of D (nt,ngp) with sample
+  weights W (nw,nt), e.g. bootstrap resample counts
+  returns np.array (4,nw,ngp), see gamma_stats
+  """
+  pos = D>0.
+  xpos = np.where(pos,D,1.).astype(np.float64)
+  return np.array([np.zeros((W.shape[0],D.shape[1]))+np.sum(W,axis=1)[:,None],
+                   np.dot(W,pos.astype(np.float64)),
+                   np.dot(W,np.where(pos,xpos,0.)),
+                   np.dot(W,np.log(xpos))])
+
+def gamma_stats(D):
+  """
+  Sufficient statistics of the gamma fit of D (nt,ngp) along axis 0
+  returns np.array (4,ngp): number of samples, number of samples > 0,
+  sum and sum of the log of the samples > 0
+  """
+  pos = D>0.
+  xpos = np.where(pos,D,1.).astype(np.float64)
+  return np.array([np.zeros(D.shape[1:])+D.shape[0],
+                   np.sum(pos,axis=0),
+                   np.sum(np.where(pos,xpos,0.),axis=0),
+                   np.sum(np.log(xpos),axis=0)])
+
+@instrument.timed('gamma_from_stats')
+def gamma_from_stats(stats,zeromax):
+  """
+  Gamma fit from sufficient statistics (see gamma_stats)
+  coef,q = gamma_from_stats(stats,zeromax)
+  stats: np.array (4,...) ; returns coef (2,...) and q (...)
+  Points with frequency of zero above zeromax or shape > 1000 are nan.
+  """
+  ntot,npos,sx,slx = stats
+  q = (ntot - npos) / ntot
+  coef = np.zeros((2,)+q.shape)*np.nan
+  pp = np.nonzero(q<=zeromax)
+  coef[0][pp],coef[1][pp] = gamma_mle(sx[pp]/npos[pp],slx[pp]/npos[pp])
+  pp = np.nonzero(coef[0] > 1000 )
+  #print("Error in spi.fspi_fit:",len(pp[0]),ngp)
+  coef[0][pp] = np.nan
+  coef[1][pp] = np.nan
+  return coef,q
+
+@instrument.timed('fspi_emp_fit')
+def fspi_emp_fit(D,zeromax):
+  """
+  Empirical (non-parametric) SPI climatology
+  clim,q = fspi_emp_fit(D,zeromax)
+  input:
+   D: np.array (nt,ngp) with the accumulated precipitation samples
+   zeromax: maximum frequency of zero to be accepted
+  returns
+   clim: np.array (nt,ngp) samples sorted along axis 0, nan at the end
+         and in all points with frequency of zero above zeromax
+   q: frequency of zero (ngp)
+  """
+  nt,ngp = D.shape
+  q = (nt - np.sum(D>0.,axis=0)) / float(nt)
+  clim = np.sort(D,axis=0).astype(np.float32)
+  clim[:,q>zeromax] = np.nan
+  return clim,q
+
+@instrument.timed('fspi_emp_eval')
+def fspi_emp_eval(D,clim,gpos=GRINGORTEN):
+  """
+  Empirical SPI: position of D in the sorted climatology clim (from
+  fspi_emp_fit) converted to a probability with the plotting position
+  p=(rank-gpos)/(n+1-2*gpos) (Gringorten for gpos=0.44) and transformed
+  to the standard normal. Ties get the mean rank, values in between two
+  samples a linearly interpolated rank.
+  input:
+   D: np.array (nt,ngp)
+   clim: np.array (nclim,ngp) sorted along axis 0, nan at the end
+  returns
+   xspi: np.array (nt,ngp)
+  """
+  nt,ngp = D.shape
+  nclim = clim.shape[0]
+  nvalid = np.sum(~np.isnan(clim),axis=0)
+  D = np.asarray(D,dtype=clim.dtype).astype(np.float64)
+  clim = clim.astype(np.float64)
+
+  # search all points at once: offset each point to a disjoint range
+  # (missing climatology values are placed at the end of the range)
+  if np.all(nvalid == 0):
+    return np.zeros((nt,ngp))*np.nan
+  xmin = min(np.nanmin(clim),np.nanmin(D))
+  xmax = max(np.nanmax(clim),np.nanmax(D))
+  span = (xmax-xmin)+2.
+  base = np.arange(ngp)*span
+  cflat = (np.where(np.isnan(clim),span-1.,clim-xmin)+base[None,:]).T.ravel()
+  Dflat = np.where(np.isnan(D),0.,D-xmin)+base[None,:]
+  ioff = (np.arange(ngp)*nclim)[None,:]
+  ileft = np.searchsorted(cflat,Dflat,side='left') - ioff
+  iright = np.searchsorted(cflat,Dflat,side='right') - ioff
+
+  # interpolated rank (1 based)
+  icol = np.arange(ngp)[None,:]
+  xlo = clim[np.clip(ileft-1,0,nclim-1),icol]
+  xhi = clim[np.clip(ileft,0,nclim-1),icol]
+  with np.errstate(invalid='ignore',divide='ignore'):
+    frac = np.clip((D-xlo)/(xhi-xlo),0.,1.)
+  rank = np.where(iright > ileft,(ileft+iright+1)*0.5,ileft+frac)
+  rank = np.where(iright == 0,0.5,rank)
+  rank = np.where(ileft >= nvalid[None,:],nvalid[None,:]+0.5,rank)
+
+  with np.errstate(invalid='ignore',divide='ignore'):
+    prob = (rank-gpos)/(nvalid[None,:]+1.-2.*gpos)
+  prob = np.clip(prob,0.001,0.999)
+  xspi = sps.ndtri(prob)
+  xspi[:,nvalid==0] = np.nan
+  xspi[np.isnan(D)]=np.nan
+  return xspi
+
+def save_emp_clim(FNAME,clim,q):
+  """
+  Save empirical SPI climatologies
+   clim: np.array (nsets,nclim,ngp), one sorted climatology (see fspi_emp_fit)
+         per calendar month or lead time, padded with nan
+   q: np.array (nsets,ngp) frequency of zero
+  """
+  fout = open(FNAME,'wb')
+  np.savez(fout,clim=clim.astype(np.float32),q=q.astype(np.float32))
+  fout.close()
+  print("File created:",FNAME)
+
+def load_emp_clim(FNAME):
+  """
+  Load empirical SPI climatologies saved by save_emp_clim
+  clim,q = load_emp_clim(FNAME)
+  """
+  zz = np.load(FNAME)
+  clim,q = zz['clim'],zz['q']
+  zz.close()
+  return clim,q
+
 def fitgamma ( samples ): 
   """fit a gamma distribution using maximum likelihood 
    http://psignifit.sourceforge.net/api/pypsignifit.psigsimultaneous-pysrc.html#fitgamma
@@ -130,31 +363,33 @@ def fitgamma ( samples ):
    
   """
   #np.seterr(invalid='raise')
-  nt,ngp = samples.shape
-  xmean = np.zeros((ngp))
-  xmeanl = np.zeros((ngp))
-  for ip in xrange(ngp):
-    xx = samples[samples[:,ip]>0.,ip]
-    xmean[ip] = np.mean(xx)
-    xmeanl[ip] = np.mean( np.log(xx))
+  stats = gamma_stats(samples)
+  return gamma_mle(stats[2]/stats[1],stats[3]/stats[1])
 
+def gamma_mle(xmean,xmeanl):
+  """
+  Newton solve of the gamma maximum likelihood equations
+  k,th = gamma_mle(xmean,xmeanl)
+   xmean: mean of the samples > 0 (np.array, any shape)
+   xmeanl: mean of the log of the samples > 0
+  returns shape (k) and scale (th), nan where the solve failed
+  """
   s = np.log ( xmean ) - xmeanl
   k = 3 - s + np.sqrt ( (s-3)**2 + 24*s)
   k /= 12 * s
   
-  ppbad = np.nonzero(s==0)[0]
-  ppbad = np.concatenate((ppbad,np.nonzero(k<=0)[0]))
+  ppbad = (s==0) | (k<=0)
   k[ppbad]=7.8
   s[ppbad]=0.06
 
-  for i in xrange ( 5 ):
+  for i in range ( 5 ):
     k -= ( np.log(k) - sps.digamma ( k ) -s ) / ( 1./k - sps.polygamma( 1, k ) )
-    ppbad = np.concatenate((ppbad,np.nonzero(k<=0)[0]))
+    ppbad = ppbad | (k<=0)
     k[ppbad]=7.8
   th = xmean / k 
   
-  if len(ppbad)> 0:
-    print(" spi.fitgamma: mle failed,",np.unique(ppbad))
+  if np.any(ppbad):
+    print(" spi.fitgamma: mle failed,",np.nonzero(ppbad.ravel())[0])
   k[ppbad]=np.nan
   th[ppbad]=np.nan
 
@@ -162,21 +397,13 @@ def fitgamma ( samples ):
 
 def rolling_sum(a, n=None,axis=0) :
   """
-  Compute rolling sum 
-  Addapted from:
-  https://stackoverflow.com/questions/28288252/fast-rolling-sum
+  Compute rolling sum in float64, nan for the first n-1 values
+  (same as rolling.rolling_sum with the default options)
   """
-  ret = np.cumsum(a, axis=axis, dtype=float)
-  if axis==1:
-    ret[:, n:] = ret[:, n:] - ret[:, :-n]
-    ret[:,0:n-1]=np.nan
-    return ret
-  elif axis==0:
-    ret[n:,:] = ret[n:,:] - ret[:-n,:]
-    ret[0:n-1,:]=np.nan
-    return ret
+  return rolling.rolling_sum(a,n,axis=axis)
 
 
+@instrument.timed('compute_clim')
 def compute_clim(FIN,FOUTN,key,extraKeys=None,extraKeysLimits={}):
   """
   Compute mean of all fields in FIN matching unique values of "key"
@@ -187,10 +414,12 @@ def compute_clim(FIN,FOUTN,key,extraKeys=None,extraKeysLimits={}):
   #key='forecastMonth'
   
   print('Compute_clim:',FIN,key)
-  fout = open(FOUTN,'w')
+  fout = open(FOUTN,'wb')
   iid = ec.codes_index_new_from_file(FIN, [key])
   key_vals = list(ec.codes_index_get(iid,key))
   key_vals.sort(key=int)
+  nread=0
+  nwrite=0
   for val in key_vals:
     ec.codes_index_select(iid, key, val)
     ikf=0
@@ -210,6 +439,7 @@ def compute_clim(FIN,FOUTN,key,extraKeys=None,extraKeysLimits={}):
           clone_id = ec.codes_clone(gid)
         xdata = xdata+xtmp
         ikf=ikf+1
+      nread=nread+1
       #print(key,val,lpresent,ec.codes_get(gid,'number'))
       ec.codes_release(gid)
     if ikf > 0:
@@ -218,12 +448,100 @@ def compute_clim(FIN,FOUTN,key,extraKeys=None,extraKeysLimits={}):
       ec.codes_set_values(clone_id, xdata)
       ec.codes_write(clone_id, fout)
       ec.codes_release(clone_id)
+      nwrite=nwrite+1
     print(key,val,ikf)
     
   ec.codes_index_release(iid)
   fout.close()
+  instrument.count_io(FIN,'read',nread)
+  instrument.count_io(FOUTN,'write',nwrite)
   print("File created:",FOUTN)
 
+def ens_summary(xspi,thresholds=SPI_DROUGHT,percentiles=SPI_PERCENTILES):
+  """
+  Ensemble summary of SPI fields
+  xmean,xprob,xperc = ens_summary(xspi,thresholds,percentiles)
+  input:
+   xspi: np.array (nens,ngp), nan for missing values
+   thresholds: list of SPI thresholds
+   percentiles: list of percentiles (0-100)
+  returns
+   xmean: np.array (ngp) ensemble mean
+   xprob: np.array (nthresholds,ngp) fraction of members below each threshold
+   xperc: np.array (npercentiles,ngp) ensemble percentiles
+   all nan where no member is valid
+  """
+  lvalid = ~np.isnan(xspi)
+  nvalid = np.sum(lvalid,axis=0).astype(np.float64)
+  nvalid[nvalid == 0] = np.nan
+  xmean = np.sum(np.where(lvalid,xspi,0.),axis=0)/nvalid
+  xprob = np.zeros((len(thresholds),xspi.shape[1]))
+  for ith,thr in enumerate(thresholds):
+    xprob[ith,:] = np.sum(np.where(lvalid,xspi,np.inf) < thr,axis=0)/nvalid
+  xperc = nan_percentiles(xspi,percentiles)
+  return xmean,xprob,xperc
+
+def nan_percentiles(x,percentiles):
+  """
+  Percentiles along the first axis ignoring nan, as np.nanpercentile
+  (linear interpolation) but with a single sort of x: nan are sorted last
+  and the percentiles are interpolated within the valid values of each point
+  xperc = nan_percentiles(x,percentiles)
+  input:
+   x: np.array (n,...)
+   percentiles: list of percentiles (0-100)
+  returns
+   xperc: np.array (npercentiles,...), nan where no value is valid
+  """
+  xsort = np.sort(x,axis=0)
+  nv = np.sum(~np.isnan(x),axis=0)
+  lvalid = nv > 0
+  nv = np.maximum(nv-1,0)
+  xperc = np.zeros((len(percentiles),)+x.shape[1:])*np.nan
+  for iperc,perc in enumerate(percentiles):
+    rank = perc/100.*nv
+    k0 = np.floor(rank).astype(int)
+    k1 = np.minimum(k0+1,nv)
+    x0 = np.take_along_axis(xsort,k0[None],axis=0)[0]
+    x1 = np.take_along_axis(xsort,k1[None],axis=0)[0]
+    with np.errstate(invalid='ignore'): # infinite values
+      xperc[iperc][lvalid] = (x0+(rank-k0)*(x1-x0))[lvalid]
+  return xperc
+
+def valid_points(D,zeromax=None,groups=None):
+  """
+  Index of the grid points worth processing
+  idx = valid_points(D,zeromax=None,groups=None)
+  input:
+   D: np.array (nt,ngp)
+   zeromax: if given, also drop the points where the frequency of zero is
+            above zeromax (in every group if groups is given)
+   groups: np.array (nt), e.g. calendar month of each sample
+  returns
+   idx: np.array with the index of the points with some valid data (not
+        all nan, i.e. present in the bitmap) passing the zero frequency test
+  """
+  lvalid = np.any(~np.isnan(D),axis=0)
+  if zeromax is not None:
+    if groups is None:
+      groups = np.zeros(D.shape[0])
+    groups = np.asarray(groups)
+    lzero = np.zeros(D.shape[1],dtype=bool)
+    for gg in np.unique(groups):
+      Dg = D[groups == gg,:]
+      lzero |= (Dg.shape[0] - np.sum(Dg>0.,axis=0)) / float(Dg.shape[0]) <= zeromax
+    lvalid &= lzero
+  return np.nonzero(lvalid)[0]
+
+def unpack_points(xp,idx,ngp,fill=np.nan):
+  """
+  Scatter packed values xp (...,len(idx)) back to the full grid (...,ngp)
+  """
+  out = np.zeros(xp.shape[:-1]+(ngp,),dtype=xp.dtype)
+  out[...] = fill
+  out[...,idx] = xp
+  return out
+
 def add_months(m1,m2):
   """"
   Simple function to add add months
@@ -240,6 +558,7 @@ def gen_for_fname(AWDIR,FTAG,SEASVER,YMD,FCONT):
   """
   return "%s/%s%s.%s.%s.grb"%(AWDIR,FTAG,SEASVER,YMD,FCONT)
 
+@instrument.timed('load_grb_file')
 def load_grb_file(FNAME,retKeys=None,verbose=False):
   """
   Loads full grib file 
@@ -253,10 +572,15 @@ def load_grb_file(FNAME,retKeys=None,verbose=False):
    xKeys : if retKeys is not None: dictionary with a list for each key requested 
   """
   
+  xx = memstore.get(FNAME,retKeys)
+  if xx is not None:
+    if verbose:
+      print('Reading (memory):',FNAME)
+    return xx
   if verbose:
     print('Reading:',FNAME)
   # open file 
-  fgrb = open(FNAME)
+  fgrb = open(FNAME,'rb')
   # find # of fields in file 
   nflds = ec.codes_count_in_file(fgrb)
   if verbose:
@@ -285,10 +609,13 @@ def load_grb_file(FNAME,retKeys=None,verbose=False):
     ec.codes_release(gid)
     
   fgrb.close()
+  instrument.count_io(FNAME,'read',nflds)
   if retKeys is not None:
     for kk in xKeys.keys():
       xKeys[kk] = np.array(xKeys[kk])
+    memstore.put(FNAME,retKeys,xdata,xKeys)
     return xdata,xKeys
   else:
+    memstore.put(FNAME,retKeys,xdata)
     return xdata
   
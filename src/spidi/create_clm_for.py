@@ -11,6 +11,35 @@ import eccodes as ec
 from spidi import core
 
 
+class MemberMean(object):
+  """
+  Mean of consecutive groups of fields (the members of each lead time),
+  accumulated in float64 in the order the fields are appended, as
+  core.compute_clim does. nan (missing) values are skipped.
+  Can be given as the keep list of core.grbio.write_messages.
+   counts: number of fields of each group
+  """
+  def __init__(self,counts):
+    self.counts = [nn for nn in counts if nn > 0]
+    self.means = []
+    self.xsum = None
+    self.nvalid = None
+    self.nfld = 0
+
+  def append(self,xtmp):
+    lvalid = ~np.isnan(xtmp)
+    if self.nfld == 0:
+      self.xsum = np.zeros(xtmp.shape)
+      self.nvalid = np.zeros(xtmp.shape)
+    self.xsum = self.xsum+np.where(lvalid,xtmp,0.)
+    self.nvalid = self.nvalid+lvalid
+    self.nfld = self.nfld+1
+    if self.nfld == self.counts[len(self.means)]:
+      with np.errstate(invalid='ignore',divide='ignore'):
+        self.means.append(self.xsum/self.nvalid)
+      self.nfld = 0
+
+
 def main(args=None):
 
   ##==========================================
@@ -28,58 +57,78 @@ def main(args=None):
       print('Exiting')
       sys.exit(-1)
     else:
-      exec(key+'="'+OPT[key]+'"')
+      globals()[key]=OPT[key]
+  ## Optional settings:
+  ##  NPROC: number of processes used for grib encoding
+  ##  PROFILE: write a json run report (timings, memory, i/o) to this file
+  OPTO=core.get_opt(['NPROC','PROFILE'],args[1:])
+  nproc=int(OPTO['NPROC'] or 1)
+  core.instrument.start(OPTO['PROFILE'],'spidi-clim-for')
       
   # testing: run create_clm_for.py  --AWDIR=/scratch/rd/need/dsuite/aaac/20170101 --SEASVER=5 --HINDYEND=2016 --HINDYSTART=1981 --YMD=20170101
 
   # 1. Load monitoring
   fnameMON="%s/MON_HIND.grb"%(AWDIR) 
-  mon_hindF,mon_keys = core.load_grb_file("%s/%s.grb"%(AWDIR,core.MONHTAG),
-                                          retKeys=['year','month'],verbose=False)
+  mon_hindF,mon_keys = core.moncache.load_mon_hind("%s/%s.grb"%(AWDIR,core.MONHTAG),
+                                                  verbose=False)
 
-  ## Loop on forecast lead time
+  ## Control member (number==0) of each lead time in the template
   FTEMPLATE=core.gen_for_fname(AWDIR,'BCFOR',SEASVER,YMD,'ENS')
-  FOUTCLM=core.gen_for_fname(AWDIR,'CLMFOR',SEASVER,YMD,'ENS')
-  fin = open(FTEMPLATE)
-  fout = open(FOUTCLM,'w')
+  templates,fYR,fMN,fM = [],[],[],[]
+  iid = ec.codes_index_new_from_file(FTEMPLATE,['number'])
+  ec.codes_index_select(iid,'number',0)
   while True:
-    gid = ec.codes_grib_new_from_file(fin)
+    gid = ec.codes_new_from_index(iid)
     if gid is None: break
-    fN = ec.codes_get(gid,'number')
-    
-    if fN==0:
-      fYR = ec.codes_get(gid,'year')
-      fMN = ec.codes_get(gid,'month')
-      fM = ec.codes_get(gid,'forecastMonth')
-      
-      clone_id = ec.codes_clone(gid)
-      ec.codes_set(clone_id,'bitmapPresent',1)
-      ec.codes_set(clone_id,'missingValue',core.ZMISS)
-      
-      Afmon=fMN+fM-1 # actual forecast month 
-      Afyear=fYR     # actual forecast year
-      yrA=0
-      if Afmon > 12:
-        Afmon = Afmon-12; Afyear=Afyear+1 ; yrA=1
-      print(fN,fYR,fMN,fM,Afmon,Afyear)
-      # loop on hindcast year searching for particular month
-      numb=0
-      for yr in range(int(HINDYSTART),int(HINDYEND)+1):
-        if yr+yrA == Afyear: continue # skip same year 
-        indME = np.nonzero((mon_keys['year'] == yr+yrA ) & (mon_keys['month'] == Afmon))[0][0]
-        xtmp = np.ma.filled(np.ma.fix_invalid(mon_hindF[indME,:]),core.ZMISS)
-        ec.codes_set_values(clone_id, xtmp)
-        ec.codes_set(clone_id,'number',numb)
-        ec.codes_write(clone_id, fout)
-        print('  ',mon_keys['year'][indME],mon_keys['month'][indME],numb)
-        numb=numb+1
-      ec.codes_release(clone_id)
+    templates.append(core.grbio.get_message(gid))
+    fYR.append(ec.codes_get(gid,'year'))
+    fMN.append(ec.codes_get(gid,'month'))
+    fM.append(ec.codes_get(gid,'forecastMonth'))
     ec.codes_release(gid)
-  fin.close()
-  fout.close()
+  ec.codes_index_release(iid)
+  isort = np.argsort(fM,kind='mergesort')
+  templates = [templates[il] for il in isort]
+  fYR,fMN,fM = np.array(fYR)[isort],np.array(fMN)[isort],np.array(fM)[isort]
+
+  ## (lead,year) -> monitoring row index table
+  Afmon=fMN+fM-1 # actual forecast month 
+  yrA=(Afmon > 12).astype(int)
+  Afmon=Afmon-12*yrA
+  Afyear=fYR+yrA # actual forecast year
+  years=np.arange(int(HINDYSTART),int(HINDYEND)+1)
+  ymTAB=(years[None,:]+yrA[:,None])*100+Afmon[:,None]
+  ymMON=np.asarray(mon_keys['year'])*100+np.asarray(mon_keys['month'])
+  imsort=np.argsort(ymMON,kind='mergesort')
+  rowTAB=imsort[np.minimum(np.searchsorted(ymMON[imsort],ymTAB),len(ymMON)-1)]
+  assert np.all(ymMON[rowTAB] == ymTAB), "Monitoring data missing for the hindcast period"
+  useTAB=(years[None,:]+yrA[:,None]) != Afyear[:,None] # skip same year 
+
+  ## Single pass: write ENS members and compute ENM from the values
+  ## decoded from the written members (as compute_clim on the ENS file)
+  FOUTCLM=core.gen_for_fname(AWDIR,'CLMFOR',SEASVER,YMD,'ENS')
   FOUTCLMENM=core.gen_for_fname(AWDIR,'CLMFOR',SEASVER,YMD,'ENM')
-  core.compute_clim(FOUTCLM,FOUTCLMENM,'forecastMonth')
+  def clm_jobs():
+    for il in range(len(templates)):
+      print(0,fYR[il],fMN[il],fM[il],Afmon[il],Afyear[il])
+      rows=rowTAB[il,useTAB[il,:]]
+      xslice=mon_hindF[rows,:]
+      for numb,indME in enumerate(rows):
+        print('  ',mon_keys['year'][indME],mon_keys['month'][indME],numb)
+        yield templates[il],[('bitmapPresent',1),('missingValue',core.ZMISS),('number',numb)],xslice[numb,:]
+      print('forecastMonth',fM[il],len(rows))
 
+  nmemb=np.sum(useTAB,axis=1)
+  xenm=MemberMean(nmemb)
+  fout = open(FOUTCLM,'wb')
+  core.grbio.write_messages(fout,clm_jobs(),nproc,keep=xenm)
+  fout.close()
+  jobsENM=[(templates[il],[('bitmapPresent',1),('missingValue',core.ZMISS),('number',0)],xmean)
+           for il,xmean in zip(np.nonzero(nmemb > 0)[0],xenm.means)]
+  fout = open(FOUTCLMENM,'wb')
+  core.grbio.write_messages(fout,jobsENM,nproc)
+  fout.close()
+  print("File created:",FOUTCLMENM)
+  core.instrument.finish()
 
 if __name__ == "__main__":
     main(sys.argv)
\ No newline at end of file
@@ -0,0 +1,248 @@
+# Run several spidi stages from a json run specification
+
+# The stages are the spidi entry points (spidi-gpcc2grib, spidi-spi-mon,
+# spidi-index-mon, spidi-cbias-seasonal, spidi-clim-for, spidi-spi-for),
+# executed as a DAG: a stage starts once the stages listed in its "after"
+# are done.
+# By default (njobs 1) the stages run one at a time in the pipeline process
+# and the decoded grib files are shared between them through core.memstore,
+# so that a file written (or read) by one stage is not decoded again by the
+# next ones. The values kept are those decoded from the written messages,
+# the results are identical to running the entry points one after the other.
+# With njobs > 1 up to njobs independent stages run concurrently, each in its
+# own (forked) process: the entry points keep their settings in module
+# variables and ecCodes is not thread safe, so they can not share a process.
+# Fields decoded by a stage running in its own process are not shared with
+# the other stages.
+#
+# Run specification, e.g.:
+# {"settings": {"AWDIR": "/scratch/dsuite/20170101", "SEASVER": "5",
+#               "HINDYSTART": "1981", "HINDYEND": "2016", "YMD": "20170101"},
+#  "njobs": 1,
+#  "stages": [
+#   {"name": "gpcc", "entry": "spidi-gpcc2grib",
+#    "options": {"IFILE": "gpcc.nc", "OFILE": "/scratch/dsuite/20170101/MON_HIND.grb",
+#                "YMDMIN": "19790101"}},
+#   {"name": "spi-mon-3", "entry": "spidi-spi-mon",
+#    "options": {"SPITSCALE": "3"}, "after": ["gpcc"]},
+#   {"name": "cbias", "entry": "spidi-cbias-seasonal", "after": ["gpcc"]},
+#   {"name": "clim-for", "entry": "spidi-clim-for", "after": ["cbias"]},
+#   {"name": "fit-3", "entry": "spidi-spi-for", "after": ["cbias"],
+#    "options": {"SPITSCALE": "3", "FTYPE": "BCFOR", "FORTYPE": "ENS",
+#                "CONFIG": "fit_hind"}},
+#   {"name": "spi-for-3", "entry": "spidi-spi-for", "after": ["fit-3"],
+#    "options": {"SPITSCALE": "3", "FTYPE": "BCFOR", "FORTYPE": "ENS",
+#                "CONFIG": "compute_spi"}}]}
+#
+# settings are passed to every stage, options to that stage only (both as
+# --KEY=value command line arguments of the entry point).
+
+from __future__ import print_function
+
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import traceback
+
+from spidi import core
+
+# entry point -> module with its main function (as in setup.py)
+ENTRIES = {'spidi-gpcc2grib':'spidi.convGpcc2Grb',
+           'spidi-spi-mon':'spidi.calc_spi_mon',
+           'spidi-index-mon':'spidi.calc_index_mon',
+           'spidi-cbias-seasonal':'spidi.cbias_seasonal',
+           'spidi-clim-for':'spidi.create_clm_for',
+           'spidi-spi-for':'spidi.calc_spi_for'}
+
+
+def load_spec(FSPEC):
+  """
+  Load and check a run specification (see above)
+  """
+  fin = open(FSPEC)
+  spec = json.load(fin)
+  fin.close()
+  spec.setdefault('settings',{})
+  names = [st['name'] for st in spec['stages']]
+  assert len(set(names)) == len(names), "Duplicated stage names in %s"%FSPEC
+  for st in spec['stages']:
+    st.setdefault('options',{})
+    st.setdefault('after',[])
+    assert st['entry'] in ENTRIES, "Unknown entry point %s in stage %s"%(st['entry'],st['name'])
+    for dep in st['after']:
+      assert dep in names, "Unknown stage %s required by %s"%(dep,st['name'])
+  return spec
+
+
+def stage_args(spec,st):
+  """
+  Command line of a stage: settings and stage options as --KEY=value
+  """
+  opts = dict(spec['settings'])
+  opts.update(st['options'])
+  return [st['entry']]+['--%s=%s'%(key,opts[key]) for key in sorted(opts)]
+
+
+def run_stage(st,args):
+  """
+  Run the main function of stage st, returns None or the error message
+  """
+  module = importlib.import_module(ENTRIES[st['entry']])
+  print('Pipeline: starting',st['name'],' '.join(args))
+  t0 = time.time()
+  try:
+    with core.instrument.stage('pipeline:'+st['name']):
+      module.main(args)
+  except SystemExit as err:
+    if err.code not in (None,0):
+      return 'exit code %s'%err.code
+  except Exception:
+    traceback.print_exc()
+    return traceback.format_exc().strip().split('\n')[-1]
+  print('Pipeline: finished',st['name'],'in %.1fs'%(time.time()-t0))
+  return None
+
+
+def stage_report(FPROFILE,name):
+  """
+  Run report of a stage running in its own process
+  e.g. run.json -> run.<name>.json
+  """
+  root,ext = os.path.splitext(FPROFILE)
+  return '%s.%s%s'%(root,name,ext or '.json')
+
+
+def _stage_process(st,args,FPROFILE,conn):
+  """
+  Body of the process running stage st, sends the result of run_stage
+  """
+  core.instrument.detach()
+  if FPROFILE is not None:
+    core.instrument.start(stage_report(FPROFILE,st['name']),'spidi-pipeline:'+st['name'],
+                          persistent=True)
+  try:
+    err = run_stage(st,args)
+  finally:
+    core.instrument.finish(force=True)
+  conn.send(err)
+  conn.close()
+
+
+def run_stage_process(st,args,FPROFILE=None):
+  """
+  Run stage st in a forked process, returns None or the error message
+  FPROFILE: pipeline run report, the stage report is written to
+            stage_report(FPROFILE,name) (not written if None)
+  """
+  if hasattr(multiprocessing,'get_context'):
+    ctx = multiprocessing.get_context('fork')
+  else:
+    ctx = multiprocessing
+  rconn,wconn = ctx.Pipe(False)
+  sys.stdout.flush()
+  proc = ctx.Process(target=_stage_process,args=(st,args,FPROFILE,wconn))
+  proc.start()
+  wconn.close()
+  try:
+    err = rconn.recv()
+  except EOFError: # died before sending its result
+    err = None
+  rconn.close()
+  proc.join()
+  if err is None and proc.exitcode != 0:
+    err = 'exit code %s'%proc.exitcode
+  return err
+
+
+def run_pipeline(spec,njobs=1,FPROFILE=None):
+  """
+  Run the stages of spec as a DAG
+  njobs: 1 runs the stages one at a time in this process, > 1 runs up to
+         njobs concurrent stages, each in its own process
+  FPROFILE: pipeline run report, used for the stage reports when njobs > 1
+  returns a dictionary stage name -> None (success), error message or
+  'skipped' (a required stage failed)
+  """
+  pending = list(spec['stages'])
+  status = {}
+  running = {}
+  cond = threading.Condition()
+
+  def worker(st,args):
+    err = run_stage_process(st,args,FPROFILE)
+    with cond:
+      status[st['name']] = err
+      del running[st['name']]
+      cond.notify()
+
+  with cond:
+    while pending or running:
+      ## stages that can not run anymore
+      for st in list(pending):
+        if any([status.get(dep,None) is not None for dep in st['after']]):
+          status[st['name']] = 'skipped'
+          pending.remove(st)
+      ## start the stages ready to run
+      ready = [st for st in pending if all([dep in status for dep in st['after']])]
+      for st in ready[0:max(1,njobs)-len(running)]:
+        pending.remove(st)
+        if njobs > 1:
+          running[st['name']] = threading.Thread(target=worker,args=(st,stage_args(spec,st)))
+          running[st['name']].start()
+        else: # in this process, sharing core.memstore with the next stages
+          status[st['name']] = run_stage(st,stage_args(spec,st))
+      if not running:
+        if not ready:
+          if pending:
+            raise ValueError("Cyclic dependencies between stages: %s"%
+                             [st['name'] for st in pending])
+          break
+        continue
+      cond.wait()
+  return status
+
+
+def main(args=None):
+  ##===================================
+  ## Get required variables
+  OPT=core.get_opt(['SPEC'],args[1:])
+  print(OPT)
+  ## Optional settings:
+  ##  NJOBS: number of stages running at the same time (default from spec or 1),
+  ##         each in its own process when > 1
+  ##  PROFILE: write a json run report (timings, memory, i/o) for all the stages,
+  ##           with NJOBS > 1 one report per stage (PROFILE stem.<stage>.json)
+  ##  MEMSTOREMAX: maximum size in MB of the decoded fields kept in memory
+  OPTO=core.get_opt(['NJOBS','PROFILE','MEMSTOREMAX'],args[1:])
+  if OPT['SPEC'] is None:
+    print('Variable: SPEC is not defined')
+    print('can be defined either in the calling environment: e.g export SPEC=value')
+    print('or in the command line as --SPEC=value')
+    print('Exiting')
+    sys.exit(-1)
+
+  # testing: run pipeline.py --SPEC=run_20170101.json --NJOBS=2
+
+  spec = load_spec(OPT['SPEC'])
+  njobs = int(OPTO['NJOBS'] or spec.get('njobs',1))
+  core.instrument.start(OPTO['PROFILE'],'spidi-pipeline',persistent=True)
+  core.memstore.enable(OPTO['MEMSTOREMAX'] and float(OPTO['MEMSTOREMAX']))
+  try:
+    status = run_pipeline(spec,njobs,OPTO['PROFILE'])
+  finally:
+    core.memstore.disable()
+    core.instrument.finish(force=True)
+
+  print('Pipeline summary:')
+  for st in spec['stages']:
+    print('  ',st['name'],status[st['name']] or 'ok')
+  if any([err is not None for err in status.values()]):
+    sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,6 @@
+# Run the tests against the source tree (src layout) when spidi is not installed
+
+import os
+import sys
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','src'))
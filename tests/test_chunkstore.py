@@ -0,0 +1,60 @@
+# Tests of the chunked array store (core.chunkstore)
+
+from __future__ import print_function
+
+import numpy as np
+
+from spidi import core
+
+
+def sample(nt,shape=(3,50),seed=0):
+  rng = np.random.RandomState(seed)
+  xdata = rng.randn(*((nt,)+shape)).astype(np.float32)
+  xdata[rng.rand(*xdata.shape) < 0.1] = np.nan
+  return xdata
+
+
+def test_append_read_round_trip(tmpdir):
+  path = str(tmpdir.join('SPI.spic'))
+  xdata = sample(17)
+  store = core.chunkstore.create(path,xdata.shape[1:],chunks=(5,16),
+                                 coords={'lead':[1,2,3]},attrs={'tscale':3})
+  ## appends not aligned with the time chunks
+  for t0,t1 in [(0,3),(3,4),(4,12),(12,17)]:
+    store.append(xdata[t0:t1],list(range(t0,t1)))
+  store = core.chunkstore.ChunkStore(path)
+  assert store.shape == xdata.shape
+  assert store.coords['time'] == list(range(17))
+  assert store.coords['lead'] == [1,2,3]
+  assert store.attrs == {'tscale':3}
+  np.testing.assert_array_equal(store.read(),xdata)
+  np.testing.assert_array_equal(store.read(slice(4,13)),xdata[4:13])
+  points = np.array([0,15,16,31,49])
+  np.testing.assert_array_equal(store.read(slice(2,9),points),xdata[2:9][...,points])
+  np.testing.assert_array_equal(store.point_series(33),xdata[...,33])
+
+
+def test_open_append(tmpdir):
+  path = str(tmpdir.join('SPI.spic'))
+  xdata = sample(20,shape=(40,),seed=1)
+  times = list(range(200001,200021))
+  store,ntold = core.chunkstore.open_append(path,(40,),times[0:10],xdata=xdata[0:10],
+                                            chunks=(6,16))
+  assert ntold == 0
+  store.append(xdata[0:10],times[0:10])
+  ## new time steps only
+  store,ntold = core.chunkstore.open_append(path,(40,),times,xdata=xdata,chunks=(6,16))
+  assert ntold == 10
+  store.append(xdata[ntold:],times[ntold:])
+  np.testing.assert_array_equal(core.chunkstore.ChunkStore(path).read(),xdata)
+  ## revised content from time step 7: appended again from there
+  xnew = xdata.copy()
+  xnew[7,3] = 99.
+  store,ntold = core.chunkstore.open_append(path,(40,),times,xdata=xnew,chunks=(6,16))
+  assert ntold == 7
+  store.append(xnew[ntold:],times[ntold:])
+  np.testing.assert_array_equal(core.chunkstore.ChunkStore(path).read(),xnew)
+  ## different attributes: new store
+  store,ntold = core.chunkstore.open_append(path,(40,),times,xdata=xnew,chunks=(6,16),
+                                            attrs={'tscale':6})
+  assert ntold == 0 and store.shape[0] == 0
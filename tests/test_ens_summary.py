@@ -0,0 +1,40 @@
+# Tests of the ensemble summary of SPI fields (core.ens_summary)
+
+from __future__ import print_function
+
+import warnings
+
+import numpy as np
+
+from spidi import core
+
+
+def sample(nens=25,ngp=200,seed=0):
+  rng = np.random.RandomState(seed)
+  xspi = rng.randn(nens,ngp).astype(np.float32)
+  xspi[rng.rand(nens,ngp) < 0.2] = np.nan
+  xspi[:,0] = np.nan    # no valid member
+  xspi[1:,1] = np.nan   # a single valid member
+  xspi[:,2] = -1.5      # equal to a threshold
+  return xspi
+
+
+def test_ens_summary_as_nan_reductions():
+  xspi = sample()
+  xmean,xprob,xperc = core.ens_summary(xspi)
+  with warnings.catch_warnings():
+    warnings.simplefilter('ignore',RuntimeWarning) # all nan point
+    np.testing.assert_allclose(xmean,np.nanmean(xspi,axis=0),rtol=1.e-5,atol=1.e-6)
+    xref = np.nanpercentile(xspi,core.SPI_PERCENTILES,axis=0)
+    xref64 = np.nanpercentile(xspi.astype(np.float64),[0,5,33,100],axis=0)
+  np.testing.assert_allclose(xperc,xref,rtol=1.e-6,atol=1.e-6)
+  np.testing.assert_allclose(core.nan_percentiles(xspi.astype(np.float64),[0,5,33,100]),
+                             xref64,rtol=1.e-12)
+  nvalid = np.sum(~np.isnan(xspi),axis=0)
+  for ith,thr in enumerate(core.SPI_DROUGHT):
+    ref = np.sum(xspi[:,1:] < thr,axis=0)/nvalid[1:].astype(np.float64)
+    np.testing.assert_allclose(xprob[ith,1:],ref,rtol=1.e-12)
+  assert np.isnan(xmean[0]) and np.all(np.isnan(xprob[:,0])) and np.all(np.isnan(xperc[:,0]))
+  np.testing.assert_array_equal(xperc[:,1],xspi[0,1])
+  np.testing.assert_array_equal(xprob[:,2],[1.,0.,0.])
+
@@ -0,0 +1,52 @@
+# Tests of the standardized index engine (core.indices)
+
+from __future__ import print_function
+
+import numpy as np
+
+from spidi import core
+
+
+def sample_precip(nyear=20,ngp=40,seed=0):
+  rng = np.random.RandomState(seed)
+  xdata = rng.gamma(2.,1.5,size=(12*nyear,ngp)).astype(np.float32)
+  xdata[rng.rand(12*nyear,ngp) < 0.1] = 0. # dry months
+  xdata[:,0] = 0. # arid point: no valid fit
+  months = np.tile(np.arange(1,13),nyear)
+  years = np.repeat(np.arange(1991,1991+nyear),12)
+  return xdata,months,years
+
+
+def test_spi_as_fspi_fit_eval():
+  tscale = 3
+  xdata,months,years = sample_precip()
+  lfit = years <= 2005
+  xind,params = core.indices.compute_indices(['spi'],{'precip':xdata},tscale,months,lfit)['spi']
+  xacc = core.rolling.rolling_sum(xdata,tscale,axis=0,dtype=np.float32,method='compensated')
+  assert np.all(np.isnan(xind[0:tscale-1]))
+  assert np.all(np.isnan(xind[:,0]))
+  for im in range(12):
+    ttfit = np.nonzero((months == im+1) & lfit & (np.arange(len(months)) >= tscale-1))[0]
+    ttout = np.nonzero((months == im+1) & (np.arange(len(months)) >= tscale-1))[0]
+    coef,q = core.fspi_fit(xacc[ttfit],core.ZeroMax)
+    pref = np.array([coef[0],coef[1],q]).astype(np.float32)
+    np.testing.assert_array_equal(params[im],pref)
+    xref = core.fspi_eval(xacc[ttout],core.ZeroMax,pref[0:2],pref[2])
+    np.testing.assert_array_equal(xind[ttout],xref.astype(np.float32))
+
+
+def test_blocks_threads_and_previous_params():
+  tscale = 6
+  xdata,months,years = sample_precip(seed=1)
+  lfit = np.ones(len(months),dtype=bool)
+  xind,params = core.indices.compute_indices(['spi'],{'precip':xdata},tscale,months,lfit)['spi']
+  acc = core.indices.accumulate(['spi'],{'precip':xdata},tscale)
+  xind2,params2 = core.indices.compute_indices(['spi'],None,tscale,months,lfit,nthreads=3,
+                                               chunk=7,acc=acc)['spi']
+  np.testing.assert_array_equal(xind,xind2)
+  np.testing.assert_array_equal(params,params2)
+  ## transform only, with the parameters of the first fit
+  xind3,params3 = core.indices.compute_indices(['spi'],{'precip':xdata},tscale,months,lfit,
+                                               params={'spi':params})['spi']
+  np.testing.assert_array_equal(xind,xind3)
+  np.testing.assert_array_equal(params,params3)
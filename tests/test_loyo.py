@@ -0,0 +1,45 @@
+# Tests of the leave-one-year-out gamma fits from sufficient statistics
+
+from __future__ import print_function
+
+import numpy as np
+
+from spidi import core
+
+
+def sample(nyear=15,nsamp=3,ngp=25,seed=0):
+  rng = np.random.RandomState(seed)
+  xdata = rng.gamma(1.5,30.,size=(nyear*nsamp,ngp))
+  xdata[rng.rand(nyear*nsamp,ngp) < 0.15] = 0.
+  xdata[:,0] = 0.            # no valid fit
+  ## frequency of zero above ZeroMax except without the first year
+  xdata[:,1] = rng.gamma(1.5,30.,size=nyear*nsamp)
+  xdata[0:nsamp,1] = 0.
+  xdata[nsamp:nyear*nsamp-nsamp:nsamp,1] = 0.
+  years = np.repeat(np.arange(2000,2000+nyear),nsamp)
+  return xdata,years
+
+
+def test_loyo_as_refit():
+  xdata,years = sample()
+  coef,q,glabels = core.fspi_fit_loyo(xdata,years,core.ZeroMax)
+  np.testing.assert_array_equal(glabels,np.unique(years))
+  assert np.all(np.isnan(coef[:,:,0]))
+  assert np.all(np.isnan(coef[1:,:,1])) and not np.any(np.isnan(coef[0,:,1]))
+  for iy,yr in enumerate(glabels):
+    cref,qref = core.fspi_fit(xdata[years != yr],core.ZeroMax)
+    np.testing.assert_allclose(q[iy],qref,rtol=1.e-12)
+    np.testing.assert_array_equal(np.isnan(coef[iy]),np.isnan(cref))
+    np.testing.assert_allclose(coef[iy],cref,rtol=1.e-6)
+
+
+def test_loyo_from_stats():
+  xdata,years = sample(seed=1)
+  glabels = np.unique(years)
+  gstats = np.array([core.gamma_stats(xdata[years == yr]) for yr in glabels])
+  coef,q = core.gamma_loyo_from_stats(gstats,core.ZeroMax)
+  assert coef.shape == (len(glabels),2,xdata.shape[1])
+  for iy,yr in enumerate(glabels):
+    cref,qref = core.gamma_from_stats(core.gamma_stats(xdata[years != yr]),core.ZeroMax)
+    np.testing.assert_allclose(q[iy],qref,rtol=1.e-12)
+    np.testing.assert_allclose(coef[iy],cref,rtol=1.e-6)
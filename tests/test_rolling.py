@@ -0,0 +1,67 @@
+# Tests of the rolling accumulation kernel (core.rolling)
+
+from __future__ import print_function
+
+import numpy as np
+import pytest
+
+from spidi import core
+
+
+def reference_sum(a,n):
+  """
+  Direct float64 rolling sum along axis 0, nan where the window is
+  incomplete or holds a nan
+  """
+  x = np.asarray(a,dtype=np.float64)
+  ret = np.zeros(x.shape)*np.nan
+  for it in range(n-1,x.shape[0]):
+    ret[it] = np.sum(x[it-n+1:it+1],axis=0)
+  return ret
+
+
+def sample(nt=240,ngp=30,seed=0):
+  rng = np.random.RandomState(seed)
+  xdata = rng.gamma(2.,50.,size=(nt,ngp)).astype(np.float32)
+  xdata[rng.rand(nt,ngp) < 0.02] = np.nan
+  return xdata
+
+
+@pytest.mark.parametrize('method',['cumsum','compensated','direct'])
+def test_rolling_sums_methods(method):
+  xdata = sample()
+  ns = [1,3,6,12]
+  rets = core.rolling.rolling_sums(xdata,ns,method=method)
+  for n in ns:
+    np.testing.assert_allclose(rets[n],reference_sum(xdata,n),rtol=1.e-12)
+    np.testing.assert_array_equal(rets[n],core.rolling.rolling_sum(xdata,n,method=method))
+
+
+@pytest.mark.parametrize('method',['compensated','direct'])
+def test_float32_as_cumsum(method):
+  xdata = sample(nt=1200,seed=1)
+  for n in (3,12):
+    xref = core.rolling.rolling_sum(xdata,n,method='cumsum')
+    x32 = core.rolling.rolling_sum(xdata,n,dtype=np.float32,method=method)
+    assert x32.dtype == np.float32
+    np.testing.assert_array_equal(np.isnan(x32),np.isnan(xref))
+    np.testing.assert_allclose(x32,xref,rtol=1.e-5)
+
+
+def test_axis_min_count_partial():
+  xdata = sample(nt=60,ngp=8,seed=2)
+  xref = core.rolling.rolling_sum(xdata,4,method='compensated')
+  xT = core.rolling.rolling_sum(xdata.T,4,axis=1,method='compensated')
+  np.testing.assert_array_equal(xT,xref.T)
+  ## windows with at least 3 valid values, missing values counted as zero
+  xmc = core.rolling.rolling_sum(xdata,4,min_count=3)
+  xz = core.rolling.rolling_sum(np.nan_to_num(xdata),4)
+  nvalid = core.rolling.rolling_sum((~np.isnan(xdata)).astype(float),4)
+  np.testing.assert_allclose(xmc[nvalid >= 3],xz[nvalid >= 3])
+  assert np.all(np.isnan(xmc[~(nvalid >= 3)]))
+  ## partial windows at the start
+  xp = core.rolling.rolling_sum(np.ones((10,1)),4,partial=True)
+  np.testing.assert_array_equal(xp[0:4,0],[1.,2.,3.,4.])
+  ## spi.rolling_sum keeps the double precision cumulative sum
+  np.testing.assert_array_equal(core.spi.rolling_sum(xdata,4),
+                                core.rolling.rolling_sum(xdata,4))